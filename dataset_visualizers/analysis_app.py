@@ -14,6 +14,7 @@ import deepgaze_pytorch  # Make sure you have the DeepGazeIII PyTorch package in
 from scipy.ndimage import zoom
 from scipy.special import logsumexp
 from helper_loaders import *
+from deepgaze_pytorch.fixations import ALGORITHM_MODES, FixationSweep
 import json
 
 
@@ -77,74 +78,13 @@ def load_deepgaze_model(device='cpu'):
         
     return model, centerbias_template
 
-# Function to calculate fixation points using different algorithms
-def get_fixation(x, y, time_interval, algorithm_mode=0, velocity_threshold=1000, dispersion_threshold=25, min_fixation_duration=0.1):
-    def calculate_velocity(x, y, time_interval):
-        velocities = [np.sqrt((x[i] - x[i - 1])**2 + (y[i] - y[i - 1])**2) / time_interval for i in range(1, len(x))]
-        return velocities
-
-    def apply_ivt(x, y, time_interval, velocity_threshold, min_fixation_duration):
-        velocities = calculate_velocity(x, y, time_interval)
-        labels = np.zeros(len(x))  # 0 = Saccade, 1 = Fixation
-        current_fixation = []
-
-        for i in range(len(velocities)):
-            if velocities[i] < velocity_threshold:
-                current_fixation.append(i + 1)  # +1 due to velocities being shorter
-            else:
-                if len(current_fixation) * time_interval >= min_fixation_duration:
-                    labels[current_fixation] = 1
-                current_fixation = []
-        return labels
-
-    def apply_idt(x, y, time_interval, dispersion_threshold, min_fixation_duration):
-        labels = np.zeros(len(x))
-        i = 0
-        while i < len(x):
-            j = i
-            while j < len(x) and (max(x[i:j + 1]) - min(x[i:j + 1])) < dispersion_threshold and (max(y[i:j + 1]) - min(y[i:j + 1])) < dispersion_threshold:
-                j += 1
-            if (j - i) * time_interval >= min_fixation_duration:
-                labels[i:j] = 1
-            i = j
-        return labels
-
-    # Apply both algorithms and combine using the selected mode
-    ivt_labels = apply_ivt(x, y, time_interval, velocity_threshold, min_fixation_duration)
-    idt_labels = apply_idt(x, y, time_interval, dispersion_threshold, min_fixation_duration)
-    
-    if algorithm_mode == 0:
-        fixation_labels = np.logical_and(ivt_labels, idt_labels).astype(int)  # AND mode
-    elif algorithm_mode == 1:
-        fixation_labels = np.logical_or(ivt_labels, idt_labels).astype(int)  # OR mode
-    elif algorithm_mode == 2:
-        fixation_labels = ivt_labels  # I-VT only
-    elif algorithm_mode == 3:
-        fixation_labels = idt_labels  # I-DT only
-    else:
-        raise ValueError("Invalid algorithm mode. Use 0 (AND), 1 (OR), 2 (I-VT), or 3 (I-DT).")
-
-    # Extract fixation sections
-    fixation_sections, avg_x, avg_y = [], [], []
-    current_fixation = []
-
-    for i, label in enumerate(fixation_labels):
-        if label == 1:
-            current_fixation.append((x[i], y[i]))
-        else:
-            if current_fixation:
-                fixation_sections.append(current_fixation)
-                avg_x.append(np.mean([p[0] for p in current_fixation]))
-                avg_y.append(np.mean([p[1] for p in current_fixation]))
-                current_fixation = []
-
-    if current_fixation:
-        fixation_sections.append(current_fixation)
-        avg_x.append(np.mean([p[0] for p in current_fixation]))
-        avg_y.append(np.mean([p[1] for p in current_fixation]))
-
-    return fixation_sections, avg_x, avg_y
+@st.cache_resource
+def load_fixation_sweep(data_path, image_path, data_loader_name, time_interval):
+    """Load the gaze samples of one recording and cache its fixation detection index.
 
+    Moving the fixation detection sliders then only queries the cached index."""
+    x, y = data_loaders[data_loader_name](data_path, image_path)
+    return FixationSweep(x, y, time_interval)
 
 # Sidebar configuration
 # Set the paths for the stimuli, data, and affiliated image folders
@@ -306,7 +246,7 @@ if st.session_state.computation_options['compute_fixations']:
     algorithm_mode_index = st.sidebar.selectbox(
         'Algorithm Mode', 
         range(4), 
-        format_func=lambda x: ['AND', 'OR', 'I-VT', 'I-DT'][x]
+        format_func=lambda x: ALGORITHM_MODES[x]
     )
 
     # Use an expander to group fixation parameters when Compute Fixations is enabled
@@ -333,17 +273,17 @@ if st.session_state.computation_options['compute_fixations']:
 # Step 1: Calculate fixation data for all selected subjects (if enabled)
 fixations_data = {}  # Store computed fixations for each subject
 max_fixation_count = 0
-data_loader = data_loaders[dataset_config['Data Loader']]
 
 
 for subject in st.session_state.selected_subjects_list:
     data_path = os.path.join(data_folder, subject, f'{selected_image.split(".")[0]}.{dataset_config["Data Suffix"]}')
     if os.path.exists(data_path):
-        x, y = data_loader(data_path, image_path)        
-        
+        fixation_sweep = load_fixation_sweep(data_path, image_path, dataset_config['Data Loader'], time_interval)
+        x, y = fixation_sweep.x, fixation_sweep.y
+
         # Calculate fixations if enabled
         if st.session_state.computation_options['compute_fixations']:
-            fixation_sections, x, y = get_fixation(x, y, time_interval, algorithm_mode=algorithm_mode_index,
+            fixation_sections, x, y = fixation_sweep.get_fixation(algorithm_mode=algorithm_mode_index,
                                                 velocity_threshold=velocity_threshold, 
                                                 dispersion_threshold=dispersion_threshold, 
                                                 min_fixation_duration=min_fixation_duration)
@@ -493,10 +433,10 @@ if st.session_state.computation_options['compute_deepgaze']:
         deepgaze_data_path = os.path.join(data_folder, deepgaze_subject, f'{selected_image.split(".")[0]}.{dataset_config["Data Suffix"]}')
         print(deepgaze_data_path)
         if os.path.exists(deepgaze_data_path):
-            x, y = data_loader(deepgaze_data_path, image_path)
-            
+            fixation_sweep = load_fixation_sweep(deepgaze_data_path, image_path, dataset_config['Data Loader'], time_interval)
+
             # Use `get_fixation` to obtain the fixation points for DeepGazeIII prediction
-            fixation_sections, deepgaze_x, deepgaze_y = get_fixation(x, y, time_interval, algorithm_mode=algorithm_mode_index,
+            fixation_sections, deepgaze_x, deepgaze_y = fixation_sweep.get_fixation(algorithm_mode=algorithm_mode_index,
                                                     velocity_threshold=velocity_threshold, 
                                                     dispersion_threshold=dispersion_threshold, 
                                                     min_fixation_duration=min_fixation_duration)
@@ -9,6 +9,7 @@ from scipy.ndimage import zoom
 from scipy.special import logsumexp
 import torch
 import deepgaze_pytorch
+from deepgaze_pytorch.fixations import get_fixation
 
 # Set the paths for the stimuli, data, and affiliated image folders
 stimuli_folder = '../Datasets/MIT1003/ALLSTIMULI/'
@@ -28,64 +29,6 @@ min_fixation_duration = 0.1  # Minimum fixation duration (seconds)
 
 
 
-def get_fixation(x, y, time_interval, velocity_threshold=1000, dispersion_threshold=25, min_fixation_duration=0.1):
-    """Run both I-DT and I-VT and return fixation sections and their average positions."""
-    def calculate_velocity(x, y, time_interval):
-        velocities = [np.sqrt((x[i] - x[i - 1])**2 + (y[i] - y[i - 1])**2) / time_interval for i in range(1, len(x))]
-        return velocities
-
-    def apply_ivt(x, y, time_interval, velocity_threshold, min_fixation_duration):
-        velocities = calculate_velocity(x, y, time_interval)
-        labels = np.zeros(len(x))  # 0 = Saccade, 1 = Fixation
-        current_fixation = []
-
-        for i in range(len(velocities)):
-            if velocities[i] < velocity_threshold:
-                current_fixation.append(i + 1)  # +1 due to velocities being shorter
-            else:
-                if len(current_fixation) * time_interval >= min_fixation_duration:
-                    labels[current_fixation] = 1
-                current_fixation = []
-        return labels
-
-    def apply_idt(x, y, time_interval, dispersion_threshold, min_fixation_duration):
-        labels = np.zeros(len(x))
-        i = 0
-        while i < len(x):
-            j = i
-            while j < len(x) and (max(x[i:j + 1]) - min(x[i:j + 1])) < dispersion_threshold and (max(y[i:j + 1]) - min(y[i:j + 1])) < dispersion_threshold:
-                j += 1
-            if (j - i) * time_interval >= min_fixation_duration:
-                labels[i:j] = 1
-            i = j
-        return labels
-
-    # Apply both algorithms and combine using OR operation
-    ivt_labels = apply_ivt(x, y, time_interval, velocity_threshold, min_fixation_duration)
-    idt_labels = apply_idt(x, y, time_interval, dispersion_threshold, min_fixation_duration)
-    fixation_labels = np.logical_and(ivt_labels, idt_labels).astype(int)
-
-    # Extract fixation sections
-    fixation_sections, avg_x, avg_y = [], [], []
-    current_fixation = []
-
-    for i, label in enumerate(fixation_labels):
-        if label == 1:
-            current_fixation.append((x[i], y[i]))
-        else:
-            if current_fixation:
-                fixation_sections.append(current_fixation)
-                avg_x.append(np.mean([p[0] for p in current_fixation]))
-                avg_y.append(np.mean([p[1] for p in current_fixation]))
-                current_fixation = []
-
-    if current_fixation:
-        fixation_sections.append(current_fixation)
-        avg_x.append(np.mean([p[0] for p in current_fixation]))
-        avg_y.append(np.mean([p[1] for p in current_fixation]))
-
-    return fixation_sections, avg_x, avg_y
-
 # List all the image files in the stimuli folder
 image_files = [f for f in os.listdir(stimuli_folder) if f.endswith('.jpeg') or f.endswith('.jpg')]
 subject_folders = [f for f in os.listdir(data_folder) if os.path.isdir(os.path.join(data_folder, f))]
@@ -0,0 +1,246 @@
+"""Columnar, memory-mapped store of the raw gaze samples of a dataset.
+
+`compile_gaze_store` parses every `DATA/<subject>/<stimulus>.<suffix>` file of a
+dataset once and writes all samples into flat float32 `t.npy`, `x.npy` and
+`y.npy` arrays next to the data folder (`DATA` -> `DATA_store`). Recordings are
+ordered by stimulus and subject, so all subjects of one stimulus are one
+contiguous slice. `GazeStore` memory-maps the arrays and returns zero-copy
+slices.
+
+Each store keeps a `Manifest` of the raw files it was built from. Compiling
+again only parses new recordings and recordings whose data file or stimulus
+image changed; all other recordings are copied from the existing store.
+
+Compile a store with
+
+    python gaze_store.py MIT1003
+"""
+import argparse
+import json
+import os
+import shutil
+
+import numpy as np
+
+from manifest import Manifest
+from stimulus_metadata import stimulus_registry
+
+
+STORE_VERSION = 1
+STORE_SUFFIX = '_store'
+
+
+def store_path_for(data_folder):
+    return os.path.normpath(data_folder) + STORE_SUFFIX
+
+
+def find_stimulus(stimuli_folder, stimulus):
+    for suffix in ['jpeg', 'jpg', 'png']:
+        image_path = os.path.join(stimuli_folder, f'{stimulus}.{suffix}')
+        if os.path.exists(image_path):
+            return image_path
+    return None
+
+
+def list_recordings(data_folder, data_suffix):
+    """All (subject, stimulus, data_path) triples of a data folder, ordered by stimulus and subject."""
+    recordings = []
+    for subject in sorted(os.listdir(data_folder)):
+        subject_folder = os.path.join(data_folder, subject)
+        if not os.path.isdir(subject_folder):
+            continue
+        for filename in os.listdir(subject_folder):
+            stimulus, suffix = os.path.splitext(filename)
+            if suffix == f'.{data_suffix}':
+                recordings.append((subject, stimulus, os.path.join(subject_folder, filename)))
+    return sorted(recordings, key=lambda recording: (recording[1], recording[0]))
+
+
+def manifest_root_for(data_folder):
+    """Raw file paths in manifests are stored relative to the dataset folder."""
+    return os.path.dirname(os.path.normpath(data_folder))
+
+
+def _load_existing_store(store_path, data_folder):
+    manifest_path = os.path.join(store_path, 'manifest.json')
+    if not os.path.exists(manifest_path):
+        return None, Manifest(manifest_root_for(data_folder))
+    try:
+        store = GazeStore(store_path)
+    except ValueError:
+        return None, Manifest(manifest_root_for(data_folder))
+    return store, Manifest.load(manifest_root_for(data_folder), manifest_path)
+
+
+def compile_gaze_store(data_folder, stimuli_folder, data_suffix, sample_loader, store_path=None, incremental=True):
+    """Parses all recordings of `data_folder` with `sample_loader` and writes them into a gaze store.
+
+    Args:
+        data_folder (str): folder with one subfolder of recordings per subject
+        stimuli_folder (str): folder with the stimulus images
+        data_suffix (str): file suffix of the recordings (e.g. `mat` or `csv`)
+        sample_loader (callable): `(data_path, image_path) -> (t, x, y)`
+        store_path (str, optional): target folder, defaults to `<data_folder>_store`
+        incremental (bool, optional): reuse unchanged recordings of an existing store. Pass
+            False after changing `sample_loader`, which the manifest cannot detect.
+    """
+    if store_path is None:
+        store_path = store_path_for(data_folder)
+
+    # read all stimulus headers once instead of once per recording
+    stimulus_registry(stimuli_folder).scan()
+
+    recordings = []
+    for subject, stimulus, data_path in list_recordings(data_folder, data_suffix):
+        image_path = find_stimulus(stimuli_folder, stimulus)
+        if image_path is None:
+            print("No stimulus for", data_path)
+            continue
+        recordings.append((subject, stimulus, data_path, image_path))
+
+    if incremental and os.path.exists(store_path):
+        old_store, manifest = _load_existing_store(store_path, data_folder)
+    else:
+        old_store, manifest = None, Manifest(manifest_root_for(data_folder))
+
+    # every recording depends on its data file and, through the loaders' coordinate conversions, on its stimulus
+    sources = {f'{subject}/{stimulus}': [data_path, image_path] for subject, stimulus, data_path, image_path in recordings}
+    unchanged, outdated, removed = manifest.diff(sources)
+    if old_store is None:
+        outdated |= unchanged
+        unchanged = set()
+    for key in removed:
+        manifest.remove(key)
+
+    if old_store is not None and not outdated and not removed:
+        # only refresh the mtimes of touched but unmodified files
+        manifest.save(os.path.join(store_path, 'manifest.json'))
+        print(f"{store_path} is up to date ({len(unchanged)} recordings)")
+        return store_path
+
+    ts, xs, ys = [], [], []
+    entries = {}
+    stimuli = {}
+    offset = 0
+    for subject, stimulus, data_path, image_path in recordings:
+        key = f'{subject}/{stimulus}'
+        if key in unchanged:
+            t, x, y = old_store.get(subject, stimulus)
+        else:
+            t, x, y = sample_loader(data_path, image_path)
+            manifest.update(key, sources[key])
+
+        ts.append(np.asarray(t, dtype=np.float32))
+        xs.append(np.asarray(x, dtype=np.float32))
+        ys.append(np.asarray(y, dtype=np.float32))
+
+        entries[key] = [offset, offset + len(x)]
+        stimulus_range = stimuli.setdefault(stimulus, [offset, offset])
+        stimulus_range[1] = offset + len(x)
+        offset += len(x)
+
+    # write to a temporary folder first to never leave a half written store behind
+    tmp_path = store_path + '.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    for name, arrays in [('t', ts), ('x', xs), ('y', ys)]:
+        values = np.concatenate(arrays) if arrays else np.empty(0, dtype=np.float32)
+        np.save(os.path.join(tmp_path, f'{name}.npy'), values)
+
+    with open(os.path.join(tmp_path, 'index.json'), 'w') as f:
+        json.dump({'version': STORE_VERSION, 'entries': entries, 'stimuli': stimuli}, f)
+
+    manifest.prune()
+    manifest.save(os.path.join(tmp_path, 'manifest.json'))
+
+    # release the memory maps of the old store before replacing it
+    del ts, xs, ys
+    old_store = None
+
+    if os.path.exists(store_path):
+        shutil.rmtree(store_path)
+    os.replace(tmp_path, store_path)
+
+    print(f"Wrote {len(entries)} recordings with {offset} samples to {store_path} "
+          f"({len(outdated)} parsed, {len(unchanged)} reused, {len(removed)} removed)")
+
+    return store_path
+
+
+class GazeStore(object):
+    """Read-only, memory-mapped view of a compiled gaze store."""
+
+    def __init__(self, store_path):
+        self.store_path = store_path
+
+        with open(os.path.join(store_path, 'index.json')) as f:
+            index = json.load(f)
+        if index['version'] != STORE_VERSION:
+            raise ValueError(f"Unsupported gaze store version {index['version']} in {store_path}")
+
+        self._entries = {tuple(key.split('/', 1)): tuple(value) for key, value in index['entries'].items()}
+        self._stimuli = {key: tuple(value) for key, value in index['stimuli'].items()}
+        self._stimulus_subjects = {}
+        for (subject, stimulus), (start, stop) in self._entries.items():
+            stimulus_start = self._stimuli[stimulus][0]
+            self._stimulus_subjects.setdefault(stimulus, {})[subject] = (start - stimulus_start, stop - stimulus_start)
+
+        self.t = np.load(os.path.join(store_path, 't.npy'), mmap_mode='r')
+        self.x = np.load(os.path.join(store_path, 'x.npy'), mmap_mode='r')
+        self.y = np.load(os.path.join(store_path, 'y.npy'), mmap_mode='r')
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def keys(self):
+        """All (subject, stimulus) pairs in the store."""
+        return list(self._entries)
+
+    def get(self, subject, stimulus):
+        """(t, x, y) samples of one recording."""
+        start, stop = self._entries[subject, stimulus]
+        return self.t[start:stop], self.x[start:stop], self.y[start:stop]
+
+    def get_stimulus(self, stimulus):
+        """(t, x, y) samples of all recordings of one stimulus as one contiguous slice.
+
+        Returns:
+            t, x, y: sample arrays
+            subjects (dict): subject -> (start, stop) of its recording within the slice
+        """
+        stimulus_start, stimulus_stop = self._stimuli[stimulus]
+        return (
+            self.t[stimulus_start:stimulus_stop],
+            self.x[stimulus_start:stimulus_stop],
+            self.y[stimulus_start:stimulus_stop],
+            dict(self._stimulus_subjects[stimulus]),
+        )
+
+
+if __name__ == '__main__':
+    import functools
+
+    from helper_loaders import sample_loaders
+
+    parser = argparse.ArgumentParser(description="Compile the gaze samples of a dataset into a memory-mapped store")
+    parser.add_argument('dataset', help="name of the dataset in dataset_config.json")
+    parser.add_argument('--base-folder', default='../Datasets/')
+    parser.add_argument('--data-folder', default='DATA', help="data folder within the dataset (e.g. DATA_unfiltered)")
+    parser.add_argument('--rebuild', action='store_true', help="parse all recordings instead of only new or changed ones")
+    args = parser.parse_args()
+
+    with open('dataset_config.json', 'r') as file:
+        dataset_config = json.load(file)['datasets'][args.dataset]
+
+    compile_gaze_store(
+        data_folder=os.path.join(args.base_folder, args.dataset, args.data_folder),
+        stimuli_folder=os.path.join(args.base_folder, args.dataset, 'ALLSTIMULI'),
+        data_suffix=dataset_config['Data Suffix'],
+        sample_loader=functools.partial(sample_loaders[dataset_config['Data Loader']], sample_rate=dataset_config['Sample Rate']),
+        incremental=not args.rebuild,
+    )
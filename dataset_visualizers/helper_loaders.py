@@ -1,9 +1,18 @@
+import asyncio
+import functools
+import os
+import time
+
 import pandas as pd
 import scipy
 import numpy as np
-from PIL import Image
 
-def preprocess_mit1003(data_path, image_path):
+from gaze_store import GazeStore, manifest_root_for, store_path_for
+from manifest import Manifest
+from stimulus_metadata import stimulus_size
+
+def load_mit1003_samples(data_path, image_path, sample_rate=240):
+    """Return the sample times and the x, y pixel coordinates of the valid MIT1003 gaze samples."""
     subject_data = scipy.io.loadmat(data_path)
     try:
         selected_key = ''
@@ -22,16 +31,26 @@ def preprocess_mit1003(data_path, image_path):
         points = np.empty((0, 2))  # Fallback for missing data
 
     # Extract x, y coordinates and filter valid points
-    filtered_points = points[(points[:, 0] >= 0) & (points[:, 1] >= 0)]
-    return filtered_points[:, 0], filtered_points[:, 1]
-        # x, y = filtered_points[:, 0], filtered_points[:, 1]
+    valid = (points[:, 0] >= 0) & (points[:, 1] >= 0)
+    filtered_points = points[valid]
+    # the recordings have no timestamps, use the sample index instead
+    timestamps = np.flatnonzero(valid) / sample_rate
+    return timestamps, filtered_points[:, 0], filtered_points[:, 1]
 
-def preprocess_eoys(data_path, image_path):
+
+def preprocess_mit1003(data_path, image_path):
+    _, x, y = load_mit1003_samples(data_path, image_path)
+    return x, y
+
+
+def load_eoys_samples(data_path, image_path, sample_rate=None):
+    """Return the timestamps and the x, y pixel coordinates of the EOYS gaze samples on the image.
+
+    The recordings contain timestamps, so `sample_rate` is ignored."""
 
     # print(data_path, image_path)
-    # Load the image to get its width
-    image = Image.open(image_path)
-    image_width = image.width
+    # Get the image width from the stimulus metadata registry
+    image_width, _ = stimulus_size(image_path)
 
     # Fixed height for the transformation
     image_height = 1080
@@ -54,10 +73,95 @@ def preprocess_eoys(data_path, image_path):
     transformed_y = filtered_data[2].values * image_height
 
     # print(transformed_y)
+    return filtered_data[0].values, transformed_x, transformed_y
+
+
+def preprocess_eoys(data_path, image_path):
+    _, transformed_x, transformed_y = load_eoys_samples(data_path, image_path)
     return transformed_x, transformed_y
+
+
+def replay_eoys(data_path, image_path, speed=1.0):
+    """Yield the (t, x, y) samples of an EOYS recording at their recorded timestamps.
+
+    Stands in for a live eye tracker feed, e.g. for `deepgaze_pytorch.online_fixations`.
+    Use `speed` to replay faster (> 1) or slower (< 1) than real time.
+    """
+    timestamps, xs, ys = load_eoys_samples(data_path, image_path)
+    start = time.monotonic()
+    for t, x, y in zip(timestamps, xs, ys):
+        delay = (t - timestamps[0]) / speed - (time.monotonic() - start)
+        if delay > 0:
+            time.sleep(delay)
+        yield t, x, y
+
+
+async def areplay_eoys(data_path, image_path, speed=1.0):
+    """Asynchronous version of `replay_eoys`."""
+    timestamps, xs, ys = load_eoys_samples(data_path, image_path)
+    start = time.monotonic()
+    for t, x, y in zip(timestamps, xs, ys):
+        delay = (t - timestamps[0]) / speed - (time.monotonic() - start)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        yield t, x, y
     
     
-data_loaders = {
+raw_data_loaders = {
     "preprocess_mit1003": preprocess_mit1003,
     "preprocess_eoys": preprocess_eoys
 }
+
+sample_loaders = {
+    "preprocess_mit1003": load_mit1003_samples,
+    "preprocess_eoys": load_eoys_samples
+}
+
+
+_gaze_stores = {}
+
+def gaze_store_for(data_path):
+    """Return the compiled `GazeStore` and its `Manifest` for the data folder containing `data_path`.
+
+    Returns (None, None) without a store. Missing stores are not remembered and a
+    recompiled store is reopened, so stores compiled while the app runs are picked up.
+    """
+    data_folder = os.path.dirname(os.path.dirname(os.path.abspath(data_path)))
+    store_path = store_path_for(data_folder)
+    try:
+        stamp = os.stat(os.path.join(store_path, 'index.json')).st_mtime_ns
+    except OSError:
+        _gaze_stores.pop(store_path, None)
+        return None, None
+
+    cached = _gaze_stores.get(store_path)
+    if cached is None or cached[0] != stamp:
+        try:
+            store = GazeStore(store_path)
+        except (OSError, ValueError):
+            return None, None
+        manifest = Manifest.load(manifest_root_for(data_folder), os.path.join(store_path, 'manifest.json'))
+        cached = _gaze_stores[store_path] = (stamp, store, manifest)
+    return cached[1], cached[2]
+
+
+def with_gaze_store(data_loader):
+    """Serve recordings from the compiled gaze store (see gaze_store.py) and fall back to `data_loader`.
+
+    A recording is only served from the store while its data file and stimulus
+    still have the size and mtime recorded in the store's manifest.
+    """
+    @functools.wraps(data_loader)
+    def load(data_path, image_path):
+        store, manifest = gaze_store_for(data_path)
+        subject = os.path.basename(os.path.dirname(data_path))
+        stimulus = os.path.splitext(os.path.basename(data_path))[0]
+        if (store is not None and (subject, stimulus) in store
+                and manifest.is_current(f'{subject}/{stimulus}', [data_path, image_path])):
+            _, x, y = store.get(subject, stimulus)
+            return x, y
+        return data_loader(data_path, image_path)
+    return load
+
+
+data_loaders = {name: with_gaze_store(data_loader) for name, data_loader in raw_data_loaders.items()}
@@ -0,0 +1,285 @@
+"""Builds pysaliency stimuli and fixation trains from the raw DATA folders.
+
+Every (subject, stimulus) recording is parsed with the sample loaders from
+`helper_loaders` and run through fixation detection in a process pool. The
+resulting `FileStimuli` and `FixationTrains` (with x_hist/y_hist and fixation
+durations) can be used directly with `deepgaze_pytorch.data` and are cached
+in an HDF5 file, so training can start without re-parsing the recordings.
+When new subjects are added to the data folder, only their recordings are
+parsed (see `cached_ingest_dataset`).
+
+Ingest a dataset with
+
+    python ingest_dataset.py MIT1003 ../MIT1003_fixations.hdf5
+"""
+import sys; sys.path.insert(0, "..")
+import argparse
+import json
+from multiprocessing import Pool
+import os
+
+import h5py
+import numpy as np
+import pysaliency
+
+from deepgaze_pytorch.fixations import fixation_segments, segments_to_fixations
+from gaze_store import find_stimulus, list_recordings, manifest_root_for
+from manifest import Manifest
+from stimulus_metadata import stimulus_registry
+from helper_loaders import sample_loaders
+
+
+DEFAULT_FIXATION_PARAMETERS = {
+    'algorithm_mode': 0,
+    'velocity_threshold': 1000,
+    'dispersion_threshold': 25,
+    'min_fixation_duration': 0.1,
+}
+
+
+def detect_recording_fixations(data_path, image_path, data_loader_name, sample_rate, fixation_parameters):
+    """Fixation x, y, onset times and durations of one recording."""
+    t, x, y = sample_loaders[data_loader_name](data_path, image_path, sample_rate=sample_rate)
+    x = np.ascontiguousarray(x)
+    y = np.ascontiguousarray(y)
+
+    time_interval = 1 / sample_rate
+    starts, ends = fixation_segments(x, y, time_interval, **fixation_parameters)
+    _, avg_x, avg_y = segments_to_fixations(x, y, starts, ends)
+
+    return avg_x, avg_y, np.asarray(t)[starts], (ends - starts) * time_interval
+
+
+def _detect_recording_fixations(job):
+    return detect_recording_fixations(*job)
+
+
+def find_recordings(data_folder, stimuli_folder, data_suffix):
+    """All (subject, stimulus, data_path, image_path) recordings of a data folder which have a stimulus."""
+    # read all stimulus headers once, the worker processes inherit the registry
+    stimulus_registry(stimuli_folder).scan()
+
+    recordings = []
+    for subject, stimulus, data_path in list_recordings(data_folder, data_suffix):
+        image_path = find_stimulus(stimuli_folder, stimulus)
+        if image_path is None:
+            print("No stimulus for", data_path)
+            continue
+        recordings.append((subject, stimulus, data_path, image_path))
+    return recordings
+
+
+def detect_fixations(recordings, data_loader_name, sample_rate, fixation_parameters, processes=None, chunksize=16):
+    """Runs `detect_recording_fixations` on all recordings in a process pool."""
+    jobs = [(data_path, image_path, data_loader_name, sample_rate, fixation_parameters)
+            for _, _, data_path, image_path in recordings]
+    if not jobs:
+        return []
+
+    print(f"Detecting fixations in {len(jobs)} recordings")
+    with Pool(processes=processes) as pool:
+        return pool.map(_detect_recording_fixations, jobs, chunksize=chunksize)
+
+
+def build_dataset(recordings, results):
+    """Assembles `(stimuli, fixations, subject_names)` from the per-recording fixations."""
+    stimulus_filenames = sorted({image_path for _, _, _, image_path in recordings})
+    stimulus_indices = {filename: n for n, filename in enumerate(stimulus_filenames)}
+    subject_names = sorted({subject for subject, _, _, _ in recordings})
+    subject_indices = {subject: n for n, subject in enumerate(subject_names)}
+
+    xs, ys, ts, ns, subjects, durations = [], [], [], [], [], []
+    for (subject, _, _, image_path), (x, y, t, duration) in zip(recordings, results):
+        if not len(x):
+            continue
+        xs.append(x)
+        ys.append(y)
+        ts.append(t)
+        durations.append(duration)
+        ns.append(stimulus_indices[image_path])
+        subjects.append(subject_indices[subject])
+
+    stimuli = pysaliency.FileStimuli(stimulus_filenames)
+    fixations = pysaliency.FixationTrains.from_fixation_trains(
+        xs, ys, ts, ns, subjects,
+        scanpath_fixation_attributes={'durations': durations},
+        scanpath_attribute_mapping={'durations': 'duration'},
+    )
+
+    return stimuli, fixations, subject_names
+
+
+def ingest_dataset(data_folder, stimuli_folder, data_suffix, data_loader_name, sample_rate,
+                   fixation_parameters=None, processes=None, chunksize=16):
+    """Parses all recordings of a data folder in parallel and returns `(stimuli, fixations, subject_names)`.
+
+    Args:
+        data_folder (str): folder with one subfolder of recordings per subject
+        stimuli_folder (str): folder with the stimulus images
+        data_suffix (str): file suffix of the recordings (e.g. `mat` or `csv`)
+        data_loader_name (str): key of the sample loader in `helper_loaders.sample_loaders`
+        sample_rate (float): sample rate of the recordings in Hz
+        fixation_parameters (dict, optional): keyword arguments for fixation detection,
+            defaults to `DEFAULT_FIXATION_PARAMETERS`
+        processes (int, optional): number of worker processes (default: number of CPUs)
+    """
+    if fixation_parameters is None:
+        fixation_parameters = DEFAULT_FIXATION_PARAMETERS
+
+    recordings = find_recordings(data_folder, stimuli_folder, data_suffix)
+    results = detect_fixations(recordings, data_loader_name, sample_rate, fixation_parameters,
+                               processes=processes, chunksize=chunksize)
+
+    return build_dataset(recordings, results)
+
+
+def _recording_key(subject, stimulus):
+    return f'{subject}/{stimulus}'
+
+
+def save_dataset(path, stimuli, fixations, subject_names, parameters, recording_results=None, manifest=None):
+    """Writes an ingested dataset to `path`.
+
+    If given, the per-recording fixations (`recording_results`: key -> (x, y, t, duration))
+    and the manifest of their raw files are stored as well, so that `cached_ingest_dataset`
+    can update the cache incrementally.
+    """
+    # the parameters are written last and checked on loading, so an interrupted write is never used
+    with h5py.File(path, 'w') as f:
+        stimuli.to_hdf5(f.create_group('stimuli'))
+        fixations.to_hdf5(f.create_group('fixations'))
+        f.attrs['subject_names'] = json.dumps(subject_names)
+        if recording_results is not None:
+            keys = sorted(recording_results)
+            lengths = [len(recording_results[key][0]) for key in keys]
+            offsets = np.concatenate(([0], np.cumsum(lengths, dtype=np.int64)))
+            data = np.zeros((offsets[-1], 4))
+            for key, start, stop in zip(keys, offsets[:-1], offsets[1:]):
+                data[start:stop] = np.stack(recording_results[key], axis=1)
+            recordings_group = f.create_group('recordings')
+            recordings_group.create_dataset('fixations', data=data)
+            recordings_group.create_dataset('offsets', data=offsets)
+            recordings_group.attrs['keys'] = json.dumps(keys)
+            f.attrs['manifest'] = json.dumps(manifest.to_json())
+        f.attrs['parameters'] = json.dumps(parameters, sort_keys=True)
+
+
+def load_dataset(path, parameters=None):
+    """Loads a cached dataset; returns None if it was ingested with different `parameters`."""
+    with h5py.File(path, 'r') as f:
+        if parameters is not None and f.attrs.get('parameters') != json.dumps(parameters, sort_keys=True):
+            return None
+        stimuli = pysaliency.read_hdf5(f['stimuli'])
+        fixations = pysaliency.read_hdf5(f['fixations'])
+        subject_names = json.loads(f.attrs['subject_names'])
+
+    return stimuli, fixations, subject_names
+
+
+def _load_manifest(path, root, parameters):
+    """Manifest of a cache built with `parameters`, or None if it cannot be updated incrementally."""
+    with h5py.File(path, 'r') as f:
+        if f.attrs.get('parameters') != json.dumps(parameters, sort_keys=True) or 'manifest' not in f.attrs:
+            return None
+        return Manifest.from_json(root, json.loads(f.attrs['manifest']))
+
+
+def _load_recording_results(path, keys):
+    """Per-recording (x, y, t, duration) of the given recording keys."""
+    with h5py.File(path, 'r') as f:
+        recordings_group = f['recordings']
+        data = recordings_group['fixations'][...]
+        offsets = recordings_group['offsets'][...]
+        indices = {key: n for n, key in enumerate(json.loads(recordings_group.attrs['keys']))}
+
+    results = {}
+    for key in keys:
+        if key in indices:
+            n = indices[key]
+            results[key] = tuple(np.ascontiguousarray(data[offsets[n]:offsets[n + 1]].T))
+    return results
+
+
+def cached_ingest_dataset(cache_path, data_folder, stimuli_folder, data_suffix, data_loader_name, sample_rate,
+                          fixation_parameters=None, processes=None):
+    """Like `ingest_dataset`, but keeps the results in an HDF5 cache at `cache_path`.
+
+    The cache records content hashes of all recordings and stimuli it was built
+    from. Running again only parses new recordings and recordings whose data file
+    or stimulus image changed; the fixations of all other recordings are reused.
+    Changing the ingestion settings rebuilds the whole cache.
+    """
+    if fixation_parameters is None:
+        fixation_parameters = DEFAULT_FIXATION_PARAMETERS
+
+    parameters = {
+        'data_folder': os.path.abspath(data_folder),
+        'stimuli_folder': os.path.abspath(stimuli_folder),
+        'data_loader': data_loader_name,
+        'sample_rate': sample_rate,
+        'fixation_parameters': fixation_parameters,
+    }
+
+    recordings = find_recordings(data_folder, stimuli_folder, data_suffix)
+    sources = {_recording_key(subject, stimulus): [data_path, image_path]
+               for subject, stimulus, data_path, image_path in recordings}
+
+    root = manifest_root_for(data_folder)
+    manifest = None
+    if os.path.exists(cache_path):
+        manifest = _load_manifest(cache_path, root, parameters)
+        if manifest is None:
+            print("Ingestion settings changed, rebuilding", cache_path)
+    if manifest is None:
+        manifest = Manifest(root)
+
+    unchanged, outdated, removed = manifest.diff(sources)
+    if unchanged and not outdated and not removed:
+        return load_dataset(cache_path, parameters)
+
+    recording_results = _load_recording_results(cache_path, unchanged) if unchanged else {}
+    outdated = set(sources) - set(recording_results)
+    for key in removed:
+        manifest.remove(key)
+    print(f"{len(outdated)} new or changed recordings, {len(recording_results)} unchanged, {len(removed)} removed")
+
+    outdated_recordings = [recording for recording in recordings if _recording_key(*recording[:2]) in outdated]
+    results = detect_fixations(outdated_recordings, data_loader_name, sample_rate, fixation_parameters,
+                               processes=processes)
+    for (subject, stimulus, data_path, image_path), result in zip(outdated_recordings, results):
+        key = _recording_key(subject, stimulus)
+        recording_results[key] = result
+        manifest.update(key, sources[key])
+    manifest.prune()
+
+    stimuli, fixations, subject_names = build_dataset(
+        recordings, [recording_results[_recording_key(subject, stimulus)] for subject, stimulus, _, _ in recordings]
+    )
+    save_dataset(cache_path, stimuli, fixations, subject_names, parameters,
+                 recording_results=recording_results, manifest=manifest)
+
+    return stimuli, fixations, subject_names
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build pysaliency stimuli and fixation trains from a dataset")
+    parser.add_argument('dataset', help="name of the dataset in dataset_config.json")
+    parser.add_argument('output', help="HDF5 cache file")
+    parser.add_argument('--base-folder', default='../Datasets/')
+    parser.add_argument('--data-folder', default='DATA', help="data folder within the dataset (e.g. DATA_unfiltered)")
+    parser.add_argument('--processes', type=int, default=None)
+    args = parser.parse_args()
+
+    with open('dataset_config.json', 'r') as file:
+        dataset_config = json.load(file)['datasets'][args.dataset]
+
+    stimuli, fixations, subject_names = cached_ingest_dataset(
+        args.output,
+        data_folder=os.path.join(args.base_folder, args.dataset, args.data_folder),
+        stimuli_folder=os.path.join(args.base_folder, args.dataset, 'ALLSTIMULI'),
+        data_suffix=dataset_config['Data Suffix'],
+        data_loader_name=dataset_config['Data Loader'],
+        sample_rate=dataset_config['Sample Rate'],
+        processes=args.processes,
+    )
+    print(f"{len(stimuli)} stimuli, {len(subject_names)} subjects, {len(fixations.train_xs)} scanpaths, {len(fixations)} fixations")
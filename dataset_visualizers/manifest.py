@@ -0,0 +1,153 @@
+"""Content-hash manifest of raw dataset files and the derived records built from them.
+
+A `Manifest` remembers size, mtime and SHA-256 of every raw file that went
+into a derived artifact (gaze store, ingestion cache, ...) and which derived
+records (e.g. `subject/stimulus`) were built from which files. On the next
+build, `Manifest.diff` tells which records have to be rebuilt: the content hash
+is only computed for files whose size or mtime changed, so checking an
+unchanged dataset costs one `stat` per file.
+"""
+import hashlib
+import json
+import os
+
+
+MANIFEST_VERSION = 1
+
+
+def file_hash(path, block_size=1 << 20):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+class Manifest(object):
+    """Tracks raw files (relative to `root`) and the derived records depending on them."""
+
+    def __init__(self, root, files=None, records=None):
+        self.root = root
+        self.files = dict(files or {})  # relative path -> {'size', 'mtime_ns', 'sha256'}
+        self.records = {key: list(sources) for key, sources in (records or {}).items()}  # record -> relative paths
+
+    @classmethod
+    def from_json(cls, root, data):
+        if data is None or data.get('version') != MANIFEST_VERSION:
+            return cls(root)
+        return cls(root, files=data['files'], records=data['records'])
+
+    def to_json(self):
+        return {'version': MANIFEST_VERSION, 'files': self.files, 'records': self.records}
+
+    @classmethod
+    def load(cls, root, path):
+        if not os.path.exists(path):
+            return cls(root)
+        with open(path) as f:
+            return cls.from_json(root, json.load(f))
+
+    def save(self, path):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.to_json(), f)
+        os.replace(tmp_path, path)
+
+    def _relative(self, path):
+        return os.path.relpath(os.path.abspath(path), os.path.abspath(self.root))
+
+    def _file_changed(self, relative_path, _hash_cache):
+        """Compares a file with its entry, updating stale size/mtime of files with unchanged content."""
+        entry = self.files.get(relative_path)
+        path = os.path.join(self.root, relative_path)
+        if not os.path.exists(path):
+            return True
+        stat = os.stat(path)
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+            return False
+        if relative_path not in _hash_cache:
+            _hash_cache[relative_path] = file_hash(path)
+        if entry is not None and entry['sha256'] == _hash_cache[relative_path]:
+            # touched but not modified
+            entry['size'] = stat.st_size
+            entry['mtime_ns'] = stat.st_mtime_ns
+            return False
+        return True
+
+    def diff(self, records):
+        """Compares the current records with the manifest.
+
+        Args:
+            records (dict): record key -> list of raw file paths it is built from
+
+        Returns:
+            unchanged (set): records which can be reused
+            outdated (set): new records and records with a changed source file
+            removed (set): records in the manifest which no longer exist
+        """
+        hash_cache = {}
+        changed_files = {}
+
+        unchanged = set()
+        outdated = set()
+        for key, sources in records.items():
+            relative_sources = [self._relative(source) for source in sources]
+            if sorted(relative_sources) != sorted(self.records.get(key, [])):
+                outdated.add(key)
+                continue
+            for source in relative_sources:
+                if source not in changed_files:
+                    changed_files[source] = self._file_changed(source, hash_cache)
+            if any(changed_files[source] for source in relative_sources):
+                outdated.add(key)
+            else:
+                unchanged.add(key)
+
+        removed = set(self.records) - set(records)
+
+        return unchanged, outdated, removed
+
+    def is_current(self, key, sources):
+        """Whether `key` was built from the current `sources`, judged by size and mtime only.
+
+        Cheap enough to check before every read of a derived record. Unlike `diff`,
+        touched but unmodified files count as changed, since no hashes are computed.
+        """
+        relative_sources = [self._relative(source) for source in sources]
+        if sorted(relative_sources) != sorted(self.records.get(key, [])):
+            return False
+        for source, relative_source in zip(sources, relative_sources):
+            entry = self.files.get(relative_source)
+            try:
+                stat = os.stat(source)
+            except OSError:
+                return False
+            if entry is None or entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns:
+                return False
+        return True
+
+    def update(self, key, sources):
+        """Records that `key` was (re)built from the current content of `sources`."""
+        relative_sources = []
+        for source in sources:
+            relative_source = self._relative(source)
+            entry = self.files.get(relative_source)
+            stat = os.stat(source)
+            if entry is None or entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns:
+                self.files[relative_source] = {
+                    'size': stat.st_size,
+                    'mtime_ns': stat.st_mtime_ns,
+                    'sha256': file_hash(source),
+                }
+            relative_sources.append(relative_source)
+        self.records[key] = relative_sources
+
+    def remove(self, key):
+        self.records.pop(key, None)
+
+    def prune(self):
+        """Drops files which no record depends on anymore."""
+        used = {source for sources in self.records.values() for source in sources}
+        for relative_path in list(self.files):
+            if relative_path not in used:
+                del self.files[relative_path]
@@ -0,0 +1,138 @@
+"""Registry of stimulus image metadata (width, height, mode and content hash).
+
+The metadata is read from the image headers once (PIL only parses the header
+until the pixels are accessed) and persisted next to the stimuli folder
+(`ALLSTIMULI` -> `ALLSTIMULI_metadata.json`). Loaders and apps take image
+dimensions from the registry instead of opening the image on every call.
+Entries are refreshed when the size or mtime of an image changes.
+
+Build the registry of a dataset with
+
+    python stimulus_metadata.py MIT1003
+"""
+import argparse
+import json
+import os
+
+from PIL import Image
+
+from manifest import file_hash
+
+
+REGISTRY_VERSION = 1
+REGISTRY_SUFFIX = '_metadata.json'
+STIMULUS_SUFFIXES = ('.jpeg', '.jpg', '.png')
+
+
+def registry_path_for(stimuli_folder):
+    return os.path.normpath(stimuli_folder) + REGISTRY_SUFFIX
+
+
+def read_stimulus_metadata(image_path):
+    """Width, height and mode from the image header, and the SHA-256 of the file."""
+    stat = os.stat(image_path)
+    with Image.open(image_path) as image:
+        width, height = image.size
+        mode = image.mode
+    return {
+        'width': width,
+        'height': height,
+        'mode': mode,
+        'sha256': file_hash(image_path),
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+    }
+
+
+class StimulusRegistry(object):
+    """Persistent metadata of the images in one stimuli folder, keyed by file name."""
+
+    def __init__(self, stimuli_folder, registry_path=None):
+        self.stimuli_folder = stimuli_folder
+        self.registry_path = registry_path if registry_path is not None else registry_path_for(stimuli_folder)
+
+        self._entries = {}
+        if os.path.exists(self.registry_path):
+            with open(self.registry_path) as f:
+                registry = json.load(f)
+            if registry.get('version') == REGISTRY_VERSION:
+                self._entries = registry['stimuli']
+
+    def save(self):
+        # unique temporary name, worker processes might save concurrently
+        tmp_path = f'{self.registry_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': REGISTRY_VERSION, 'stimuli': self._entries}, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.registry_path)
+
+    def _refresh(self, filename):
+        """Re-reads the metadata of `filename` if it is missing or outdated; returns whether it changed."""
+        entry = self._entries.get(filename)
+        stat = os.stat(os.path.join(self.stimuli_folder, filename))
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+            return False
+        self._entries[filename] = read_stimulus_metadata(os.path.join(self.stimuli_folder, filename))
+        return True
+
+    def scan(self):
+        """Reads the metadata of all new or changed stimuli and drops deleted ones."""
+        filenames = [filename for filename in sorted(os.listdir(self.stimuli_folder))
+                     if filename.lower().endswith(STIMULUS_SUFFIXES)]
+        changed = False
+        for filename in filenames:
+            changed |= self._refresh(filename)
+        for filename in set(self._entries) - set(filenames):
+            del self._entries[filename]
+            changed = True
+        if changed:
+            self.save()
+        return self
+
+    def __contains__(self, filename):
+        return filename in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, filename):
+        """Metadata dict (`width`, `height`, `mode`, `sha256`, `size`, `mtime_ns`) of one stimulus."""
+        if self._refresh(filename):
+            self.save()
+        return self._entries[filename]
+
+    def image_size(self, filename):
+        """(width, height) of one stimulus."""
+        entry = self.get(filename)
+        return entry['width'], entry['height']
+
+
+_registries = {}
+
+def stimulus_registry(stimuli_folder):
+    """Shared `StimulusRegistry` of a stimuli folder."""
+    stimuli_folder = os.path.abspath(stimuli_folder)
+    if stimuli_folder not in _registries:
+        _registries[stimuli_folder] = StimulusRegistry(stimuli_folder)
+    return _registries[stimuli_folder]
+
+
+def stimulus_metadata(image_path):
+    """Metadata of the stimulus at `image_path` from the registry of its folder."""
+    stimuli_folder, filename = os.path.split(os.path.abspath(image_path))
+    return stimulus_registry(stimuli_folder).get(filename)
+
+
+def stimulus_size(image_path):
+    """(width, height) of the stimulus at `image_path` without opening the image."""
+    metadata = stimulus_metadata(image_path)
+    return metadata['width'], metadata['height']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Read the metadata of all stimuli of a dataset")
+    parser.add_argument('dataset', help="name of the dataset folder")
+    parser.add_argument('--base-folder', default='../Datasets/')
+    args = parser.parse_args()
+
+    registry = stimulus_registry(os.path.join(args.base_folder, args.dataset, 'ALLSTIMULI')).scan()
+    print(f"{len(registry)} stimuli in {registry.registry_path}")
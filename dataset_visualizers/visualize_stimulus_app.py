@@ -1,9 +1,11 @@
+import sys; sys.path.insert(0, "..")
 import streamlit as st
 import scipy.io
 import matplotlib.pyplot as plt
 import numpy as np
 import os
 import matplotlib.image as mpimg
+from deepgaze_pytorch.fixations import get_fixation
 
 # Set the paths for the stimuli, data, and affiliated image folders
 stimuli_folder = '../Datasets/MIT1003/ALLSTIMULI/'
@@ -102,54 +104,18 @@ if os.path.exists(image_path):
                 dispersion_threshold = 25  # Spatial dispersion threshold in pixels for I-DT
                 min_fixation_duration = 0.1  # Minimum fixation duration in seconds
 
-                # Helper function: Calculate point-to-point velocities (I-VT)
-                def calculate_velocity(x, y, time_interval):
-                    velocities = []
-                    for i in range(1, len(x)):
-                        dx = x[i] - x[i - 1]
-                        dy = y[i] - y[i - 1]
-                        velocity = np.sqrt(dx**2 + dy**2) / time_interval
-                        velocities.append(velocity)
-                    return velocities
-
-                # Helper function: Apply I-VT algorithm
-                def apply_ivt(x, y, time_interval, velocity_threshold, min_fixation_duration):
-                    velocities = calculate_velocity(x, y, time_interval)
-                    fixations, saccades = [], []
-                    current_fixation = []
-
-                    for i in range(len(velocities)):
-                        if velocities[i] < velocity_threshold:
-                            current_fixation.append((x[i], y[i]))
-                        else:
-                            if len(current_fixation) > 0:
-                                if len(current_fixation) * time_interval >= min_fixation_duration:
-                                    fixations.append(np.array(current_fixation))
-                                current_fixation = []
-                    return fixations
-
-                # Helper function: Apply I-DT algorithm
-                def apply_idt(x, y, time_interval, dispersion_threshold, min_fixation_duration):
-                    fixations, saccades = [], []
-                    i = 0
-                    while i < len(x):
-                        j = i
-                        while j < len(x) and max(x[i:j + 1]) - min(x[i:j + 1]) < dispersion_threshold and \
-                              max(y[i:j + 1]) - min(y[i:j + 1]) < dispersion_threshold:
-                            j += 1
-                        if (j - i) * time_interval >= min_fixation_duration:
-                            fixations.append(np.column_stack((x[i:j], y[i:j])))
-                        i = j
-                    return fixations
-
                 # Visualize fixations and saccades based on the selected algorithm
                 if run_ivt:
-                    ivt_fixations = apply_ivt(x, y, time_interval, velocity_threshold, min_fixation_duration)
+                    ivt_fixations, _, _ = get_fixation(x, y, time_interval, algorithm_mode=2,
+                                                       velocity_threshold=velocity_threshold,
+                                                       min_fixation_duration=min_fixation_duration)
                     for fixation in ivt_fixations:
                         ax.plot(fixation[:, 0], fixation[:, 1], marker='o', color='blue', markersize=5, label='I-VT Fixation')
 
                 if run_idt:
-                    idt_fixations = apply_idt(x, y, time_interval, dispersion_threshold, min_fixation_duration)
+                    idt_fixations, _, _ = get_fixation(x, y, time_interval, algorithm_mode=3,
+                                                       dispersion_threshold=dispersion_threshold,
+                                                       min_fixation_duration=min_fixation_duration)
                     for fixation in idt_fixations:
                         ax.plot(fixation[:, 0], fixation[:, 1], marker='x', color='green', markersize=5, label='I-DT Fixation')
 
@@ -1,8 +1,16 @@
 from collections import Counter
+import hashlib
 import io
+import json
+import multiprocessing
+from multiprocessing import shared_memory
 import os
 import pickle
 import random
+import struct
+import time
+import uuid
+import weakref
 
 from boltons.iterutils import chunked
 import lmdb
@@ -10,10 +18,12 @@ import numpy as np
 from PIL import Image
 import pysaliency
 from pysaliency.datasets import create_subset
-from pysaliency.utils import remove_trailing_nans
+from scipy.ndimage import zoom
 import torch
 from tqdm import tqdm
 
+from .modules import downsampled_size
+
 
 def ensure_color_image(image):
     if len(image.shape) == 2:
@@ -21,24 +31,493 @@ def ensure_color_image(image):
     return image
 
 
-def x_y_to_sparse_indices(xs, ys):
-    # Converts list of x and y coordinates into indices and values for sparse mask
-    x_inds = []
-    y_inds = []
-    values = []
-    pair_inds = {}
-
-    for x, y in zip(xs, ys):
-        key = (x, y)
-        if key not in pair_inds:
-            x_inds.append(x)
-            y_inds.append(y)
-            pair_inds[key] = len(x_inds) - 1
-            values.append(1)
+def history_windows(hist, included_fixations):
+    """Selects the `included_fixations` of every row of a NaN padded fixation history.
+
+    Indices refer to the history without its trailing NaNs, like indexing the rows
+    after `remove_trailing_nans`.
+
+    Returns:
+        windows: (N, k) float32 array with NaN for missing fixations
+        available: (N, k) bool array, False where the history is too short
+    """
+    hist = np.asarray(hist)
+    rows, columns = hist.shape
+    included_fixations = np.asarray(included_fixations, dtype=int)
+
+    valid = ~np.isnan(hist)
+    lengths = np.where(valid.any(axis=1), columns - np.argmax(valid[:, ::-1], axis=1), 0) if columns else np.zeros(rows, dtype=int)
+
+    indices = np.where(included_fixations < 0, lengths[:, np.newaxis] + included_fixations, included_fixations)
+    available = (indices >= 0) & (indices < lengths[:, np.newaxis])
+
+    windows = np.full((rows, len(included_fixations)), np.nan, dtype=np.float32)
+    row_indices, window_indices = np.nonzero(available)
+    windows[row_indices, window_indices] = hist[row_indices, indices[row_indices, window_indices]]
+
+    return windows, available
+
+
+def downsample_image(image, downsample):
+    """Nearest neighbour downsampling of an (height, width, channels) image.
+
+    Selects the same pixels as the `F.interpolate(x, scale_factor=1 / downsample)`
+    at the beginning of the models' forward passes.
+    """
+    height, width = downsampled_size(image.shape[:2], downsample)
+    rows = np.floor(np.arange(height) * downsample).astype(int)
+    columns = np.floor(np.arange(width) * downsample).astype(int)
+    return image[rows][:, columns]
+
+
+def decode_image(image_bytes, downsample=1):
+    """Decodes an encoded image into an RGB uint8 array, optionally downsampled.
+
+    JPEGs are decoded directly at the reduced scale (DCT scaling), which is much
+    faster than decoding the full image. The result is close to, but not identical
+    with, nearest neighbour downsampling of the full resolution image. Other
+    formats are decoded fully and downsampled with `downsample_image`.
+    """
+    image = Image.open(io.BytesIO(image_bytes))
+    if downsample == 1:
+        return np.array(image.convert('RGB'))
+
+    full_size = image.size
+    height, width = downsampled_size((image.height, image.width), downsample)
+    image.draft('RGB', (width, height))
+
+    if image.size == full_size:
+        return downsample_image(np.array(image.convert('RGB')), downsample)
+
+    # the scaled JPEG is at most one pixel larger than the target, unless the scale was not supported
+    if image.width > width + 1 or image.height > height + 1:
+        image = image.resize((width, height), Image.NEAREST)
+
+    return np.array(image.convert('RGB'))[:height, :width]
+
+
+# stands in for the image where only the centerbias is loaded (datasets with cached features)
+_NO_IMAGE = np.empty((0, 0, 0), dtype=np.uint8)
+
+
+class ImageCache(object):
+    """Unbounded per-process cache of (image, centerbias) pairs.
+
+    Every DataLoader worker fills its own copy. This needs no shared memory and is
+    the cache used without a byte budget; see `SharedImageCache` for a budgeted cache
+    which is shared between workers.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, key):
+        """The cached (image, centerbias) of `key`, or None."""
+        data = self._entries.get(key)
+        if data is None:
+            self._misses += 1
         else:
-            values[pair_inds[key]] += 1
+            self._hits += 1
+        return data
+
+    def put(self, key, image, centerbias):
+        self._entries[key] = image, centerbias
+
+    def get_or_load(self, key, load):
+        """Cached (image, centerbias) of `key`; calls `load(key)` and caches its result on a miss."""
+        data = self.get(key)
+        if data is None:
+            image, centerbias = load(key)
+            data = image, centerbias.astype(np.float32)
+            self.put(key, *data)
+        return data
+
+    def stats(self):
+        """Hit and miss counts of this process, the cached bytes and the number of cached entries."""
+        return {
+            'hits': self._hits,
+            'misses': self._misses,
+            'evictions': 0,
+            'bytes': sum(image.nbytes + centerbias.nbytes for image, centerbias in self._entries.values()),
+            'entries': len(self._entries),
+        }
 
-    return np.array([y_inds, x_inds]), values
+    def close(self):
+        self._entries.clear()
+
+
+def _make_image_cache(size, cache_bytes=None):
+    """`SharedImageCache` with the given byte budget, or an `ImageCache` without one."""
+    if cache_bytes is None:
+        return ImageCache()
+    return SharedImageCache(size, cache_bytes)
+
+
+class SharedImageCache(object):
+    """Byte-budgeted LRU cache of (image, centerbias) pairs in shared memory.
+
+    Every entry lives in its own named shared memory segment and a shared table
+    keeps track of the entries, their last use and the hit/miss/eviction counters.
+    When the cache is handed to DataLoader workers (by fork or by pickling), all
+    workers see the same entries, so every image is kept only once. The lock uses the
+    default multiprocessing start method, which is also what DataLoader uses by default.
+
+    Args:
+        size (int): number of keys (0, ..., size - 1)
+        budget_bytes (int, optional): maximal total size of the cached arrays. Least
+            recently used entries are evicted to stay within it (default: unlimited).
+    """
+
+    _COUNTERS = ['hits', 'misses', 'evictions', 'bytes', 'clock', 'serial']
+
+    def __init__(self, size, budget_bytes=None):
+        self.size = size
+        self.budget_bytes = budget_bytes
+        self._token = uuid.uuid4().hex[:8]
+        self._lock = multiprocessing.Lock()
+        self._owner_pid = os.getpid()
+
+        table_dtype = self._table_dtype()
+        nbytes = len(self._COUNTERS) * 8 + max(size, 1) * table_dtype.itemsize
+        self._table_shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        self._attach()
+        self._counters[:] = 0
+        self._table['cached'] = False
+
+    @staticmethod
+    def _table_dtype():
+        return np.dtype([
+            ('cached', bool),
+            ('serial', np.int64),
+            ('last_used', np.int64),
+            ('nbytes', np.int64),
+            ('image_dtype', 'S8'),
+            ('image_shape', np.int64, 3),
+            ('centerbias_shape', np.int64, 2),
+        ])
+
+    def _attach(self):
+        buffer = self._table_shm.buf
+        self._counters = np.ndarray(len(self._COUNTERS), dtype=np.int64, buffer=buffer)
+        self._table = np.ndarray(self.size, dtype=self._table_dtype(), buffer=buffer, offset=self._counters.nbytes)
+        # runs on `close`, garbage collection or at exit, whatever comes first
+        self._finalizer = weakref.finalize(self, self._release, self._table_shm, self._token, self.size, self._owner_pid)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ['_table_shm', '_counters', '_table', '_finalizer']:
+            del state[name]
+        state['_table_name'] = self._table_shm.name
+        return state
+
+    def __setstate__(self, state):
+        table_name = state.pop('_table_name')
+        self.__dict__.update(state)
+        self._table_shm = shared_memory.SharedMemory(name=table_name)
+        self._attach()
+
+    def _segment_name(self, key, serial):
+        return 'dg{}_{}_{}'.format(self._token, key, serial)
+
+    def _unlink(self, key):
+        entry = self._table[key]
+        segment = shared_memory.SharedMemory(name=self._segment_name(key, entry['serial']))
+        segment.close()
+        segment.unlink()
+        entry['cached'] = False
+        self._counters[3] -= entry['nbytes']
+
+    def get(self, key):
+        """Copies of the cached (image, centerbias) of `key`, or None."""
+        with self._lock:
+            entry = self._table[key]
+            if not entry['cached']:
+                self._counters[1] += 1
+                return None
+            self._counters[0] += 1
+            self._counters[4] += 1
+            entry['last_used'] = self._counters[4]
+
+            segment = shared_memory.SharedMemory(name=self._segment_name(key, entry['serial']))
+            try:
+                image_shape = tuple(entry['image_shape'])
+                image_dtype = np.dtype(entry['image_dtype'].decode('ascii'))
+                image = np.ndarray(image_shape, dtype=image_dtype, buffer=segment.buf).copy()
+                centerbias = np.ndarray(tuple(entry['centerbias_shape']), dtype=np.float32, buffer=segment.buf,
+                                        offset=image.nbytes).copy()
+            finally:
+                segment.close()
+
+        return image, centerbias
+
+    def put(self, key, image, centerbias):
+        """Caches (image, centerbias) of `key`, evicting least recently used entries if necessary."""
+        image = np.ascontiguousarray(image)
+        centerbias = np.ascontiguousarray(centerbias, dtype=np.float32)
+        nbytes = image.nbytes + centerbias.nbytes
+        if self.budget_bytes is not None and nbytes > self.budget_bytes:
+            return
+
+        with self._lock:
+            if self._table[key]['cached']:
+                return
+            self._counters[5] += 1
+            serial = int(self._counters[5])
+
+        segment = shared_memory.SharedMemory(name=self._segment_name(key, serial), create=True, size=max(nbytes, 1))
+        np.ndarray(image.shape, dtype=image.dtype, buffer=segment.buf)[...] = image
+        np.ndarray(centerbias.shape, dtype=np.float32, buffer=segment.buf, offset=image.nbytes)[...] = centerbias
+
+        with self._lock:
+            entry = self._table[key]
+            if entry['cached']:
+                # another worker was faster
+                segment.close()
+                segment.unlink()
+                return
+
+            if self.budget_bytes is not None:
+                while self._counters[3] + nbytes > self.budget_bytes:
+                    cached_keys = np.flatnonzero(self._table['cached'])
+                    self._unlink(cached_keys[np.argmin(self._table['last_used'][cached_keys])])
+                    self._counters[2] += 1
+
+            self._counters[4] += 1
+            entry['serial'] = serial
+            entry['last_used'] = self._counters[4]
+            entry['nbytes'] = nbytes
+            entry['image_dtype'] = image.dtype.str.encode('ascii')
+            entry['image_shape'] = image.shape
+            entry['centerbias_shape'] = centerbias.shape
+            entry['cached'] = True
+            self._counters[3] += nbytes
+
+        segment.close()
+
+    def get_or_load(self, key, load):
+        """Cached (image, centerbias) of `key`; calls `load(key)` and caches its result on a miss."""
+        data = self.get(key)
+        if data is None:
+            image, centerbias = load(key)
+            centerbias = centerbias.astype(np.float32)
+            self.put(key, image, centerbias)
+            data = image, centerbias
+        return data
+
+    def stats(self):
+        """Hit, miss and eviction counts, the cached bytes and the number of cached entries."""
+        with self._lock:
+            counters = dict(zip(self._COUNTERS, self._counters.tolist()))
+            entries = int(self._table['cached'].sum())
+        return {
+            'hits': counters['hits'],
+            'misses': counters['misses'],
+            'evictions': counters['evictions'],
+            'bytes': counters['bytes'],
+            'entries': entries,
+        }
+
+    @staticmethod
+    def _release(table_shm, token, size, owner_pid):
+        if os.getpid() == owner_pid:
+            table = np.ndarray(size, dtype=SharedImageCache._table_dtype(), buffer=table_shm.buf,
+                               offset=len(SharedImageCache._COUNTERS) * 8)
+            for key in np.flatnonzero(table['cached']):
+                segment = shared_memory.SharedMemory(name='dg{}_{}_{}'.format(token, key, table[key]['serial']))
+                segment.close()
+                segment.unlink()
+            del table
+        table_shm.close()
+        if os.getpid() == owner_pid:
+            table_shm.unlink()
+
+    def close(self):
+        """Releases the shared memory; the process which created the cache also removes all entries."""
+        self._counters = None
+        self._table = None
+        self._finalizer()
+
+
+class FeatureCache(object):
+    """Readout resolution backbone features of the stimuli of a dataset, stored as float16.
+
+    The backbones of the DeepGaze models are frozen, so their features (the
+    output of the model's `extract_features`) only have to be computed once per
+    stimulus, see `build_feature_cache`. The features of all stimuli are
+    appended to one raw float16 file (`features.f16`) that is memory mapped for
+    reading; `index.json` holds offset, shape and stimulus identity (see
+    `stimulus_identity`) of the features of each stimulus and the `metadata` of
+    the model they were computed with.
+    """
+    VERSION = 2
+
+    def __init__(self, path, metadata=None):
+        """
+        Args:
+            path (str): cache directory, created if it doesn't exist
+            metadata (dict, optional): description of the feature extractor. If the
+                cache has been built with different metadata, a ValueError is raised.
+        """
+        self.path = os.path.expanduser(path)
+        self.index_path = os.path.join(self.path, 'index.json')
+        self.data_path = os.path.join(self.path, 'features.f16')
+
+        self.entries = {}
+        self.metadata = metadata
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                index = json.load(f)
+            if index['version'] not in [1, self.VERSION]:
+                raise ValueError("Unsupported feature cache version {}".format(index['version']))
+            if metadata is not None and index['metadata'] != json.loads(json.dumps(metadata)):
+                raise ValueError("Feature cache {} was built with {}, not {}".format(self.path, index['metadata'], metadata))
+            # entries of version 1 caches have no stimulus identity and get rebuilt
+            self.entries = {int(key): (entry + [None])[:3] for key, entry in index['entries'].items()}
+            self.metadata = index['metadata']
+
+        self._features = None
+
+    def __getstate__(self):
+        # workers map the file themselves instead of receiving a copy of the data
+        state = dict(self.__dict__)
+        state['_features'] = None
+        return state
+
+    def __contains__(self, n):
+        return n in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, n):
+        """float16 (channels, height, width) features of stimulus `n`."""
+        if self._features is None:
+            self._features = np.memmap(self.data_path, dtype=np.float16, mode='r')
+        offset, shape, _ = self.entries[n]
+        return np.array(self._features[offset:offset + int(np.prod(shape))]).reshape(shape)
+
+    def stimulus_id(self, n):
+        """Identity of the stimulus the features of `n` were computed from (None if unknown)."""
+        return self.entries[n][2] if n in self.entries else None
+
+    def mismatched(self, stimulus_ids):
+        """Indices of the stimuli (given by their identities) without matching features in the cache."""
+        return [n for n, stimulus_id in enumerate(stimulus_ids) if self.stimulus_id(n) != stimulus_id]
+
+    def append(self, items):
+        """Adds the features of several stimuli (iterable of (n, stimulus_id, features)) and saves the index.
+
+        Features of an `n` which is already in the cache replace the old ones (whose
+        data stays unused in the file).
+        """
+        os.makedirs(self.path, exist_ok=True)
+        offset = os.path.getsize(self.data_path) // 2 if os.path.exists(self.data_path) else 0
+        try:
+            with open(self.data_path, 'ab') as f:
+                for n, stimulus_id, features in items:
+                    features = np.ascontiguousarray(features, dtype=np.float16)
+                    f.write(features.tobytes())
+                    self.entries[n] = [offset, list(features.shape), stimulus_id]
+                    offset += features.size
+        finally:
+            self._save_index()
+        self._features = None
+
+    def _save_index(self):
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                'version': self.VERSION,
+                'metadata': self.metadata,
+                'entries': {str(n): entry for n, entry in self.entries.items()},
+            }, f)
+        os.replace(tmp_path, self.index_path)
+
+
+_file_hashes = {}
+
+
+def stimulus_identity(stimuli, n):
+    """Identity of stimulus `n`: the SHA-1 of its file for `pysaliency.FileStimuli`, else its `stimulus_id`.
+
+    File hashes are remembered per process as long as size and mtime of the file don't change.
+    """
+    filenames = getattr(stimuli, 'filenames', None)
+    if filenames is None:
+        return str(stimuli.stimulus_ids[n])
+
+    filename = os.path.abspath(filenames[n])
+    stat = os.stat(filename)
+    key = filename, stat.st_size, stat.st_mtime_ns
+    if key not in _file_hashes:
+        sha1 = hashlib.sha1()
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(block)
+        _file_hashes[key] = sha1.hexdigest()
+    return _file_hashes[key]
+
+
+def _open_feature_cache(feature_cache, stimuli):
+    if feature_cache is None:
+        return None
+    if not isinstance(feature_cache, FeatureCache):
+        feature_cache = FeatureCache(feature_cache)
+    mismatched = feature_cache.mismatched([stimulus_identity(stimuli, n) for n in range(len(stimuli))])
+    if mismatched:
+        raise ValueError("Feature cache {} has no features of {} of the {} stimuli (or features of other images), "
+                         "run build_feature_cache first".format(feature_cache.path, len(mismatched), len(stimuli)))
+    return feature_cache
+
+
+def feature_cache_metadata(model):
+    """Describes the feature extraction of `model` for `FeatureCache`."""
+    return {
+        'model': type(model).__name__,
+        'targets': list(model.features.targets),
+        'downsample': model.downsample,
+        'readout_factor': model.readout_factor,
+    }
+
+
+def build_feature_cache(model, stimuli, path, device=None):
+    """Computes the readout resolution features of all `stimuli` missing in the cache at `path`.
+
+    Entries computed from other images than the current `stimuli` (see `stimulus_identity`)
+    are recomputed as well.
+
+    Args:
+        model: a `DeepGazeII`, `DeepGazeIII` or `DeepGazeIIIMixture` (anything with `extract_features`)
+        stimuli (pysaliency.Stimuli): the stimuli, keyed by index as in the datasets
+
+    Returns:
+        FeatureCache
+    """
+    feature_cache = FeatureCache(path, metadata=feature_cache_metadata(model))
+    stimulus_ids = [stimulus_identity(stimuli, n) for n in range(len(stimuli))]
+    missing = feature_cache.mismatched(stimulus_ids)
+    if not missing:
+        return feature_cache
+
+    if device is None:
+        device = next(model.parameters()).device
+
+    def compute_features():
+        with torch.no_grad():
+            for n in tqdm(missing):
+                image = ensure_color_image(np.array(stimuli.stimuli[n])).transpose(2, 0, 1)
+                image = torch.from_numpy(np.ascontiguousarray(image))[np.newaxis].to(device)
+                # the centerbias only determines the output size
+                centerbias = torch.zeros((1, image.shape[2], image.shape[3]), device=device)
+                features = model.extract_features(image, centerbias)
+                yield n, stimulus_ids[n], features[0].to(torch.float16).cpu().numpy()
+
+    print("Computing features of {} stimuli into {}".format(len(missing), feature_cache.path))
+    feature_cache.append(compute_features())
+
+    return feature_cache
 
 
 class ImageDataset(torch.utils.data.Dataset):
@@ -50,101 +529,135 @@ class ImageDataset(torch.utils.data.Dataset):
         lmdb_path=None,
         transform=None,
         cached=None,
-        average='fixation'
+        average='fixation',
+        downsample=1,
+        cache_bytes=None,
+        feature_cache=None,
+        centerbias_dtype='float32',
+        centerbias_factor=1,
+        decoded_images=False,
+        export_processes=1,
     ):
+        """
+        Args:
+            cached (bool, optional): keep images and centerbias predictions in memory.
+                Defaults to True for datasets with less than 100 stimuli or if `cache_bytes` is given.
+            downsample (int, optional): return images downsampled by this factor. Set it to the
+                `downsample` of the model, which then skips its own downsampling. Images from
+                an LMDB are decoded directly at the reduced scale if they are JPEGs.
+            cache_bytes (int, optional): byte budget of the image cache. With a budget, the cache
+                is a `SharedImageCache` shared by all DataLoader workers; without one, every
+                worker keeps its own unbounded `ImageCache`.
+            feature_cache (FeatureCache or str, optional): return the cached backbone features
+                of the stimuli as `features` instead of the `image` (see `build_feature_cache`).
+                Only the centerbias is then loaded and cached: from an LMDB, the image part of
+                the records is skipped; otherwise the centerbias model gets the pysaliency stimulus.
+            centerbias_dtype, centerbias_factor, decoded_images (optional): record format used
+                when writing missing records to `lmdb_path` (see `export_dataset_to_lmdb`).
+                Existing records are read in whatever format they were written in.
+            export_processes (int, optional): worker processes of the LMDB export. The default of 1
+                exports in this process; pass more (or None for one per CPU) to opt into a pool.
+        """
         self.stimuli = stimuli
         self.fixations = fixations
         self.centerbias_model = centerbias_model
         self.lmdb_path = lmdb_path
         self.transform = transform
         self.average = average
+        self.downsample = downsample
+        self.feature_cache = _open_feature_cache(feature_cache, stimuli)
 
-        # cache only short dataset
+        # without a byte budget, cache only short datasets
         if cached is None:
-            cached = len(self.stimuli) < 100
+            cached = cache_bytes is not None or (lmdb_path is None and len(self.stimuli) < 100)
 
         cache_fixation_data = cached
 
         if lmdb_path is not None:
-            _export_dataset_to_lmdb(stimuli, centerbias_model, lmdb_path)
+            export_dataset_to_lmdb(
+                stimuli, centerbias_model, lmdb_path,
+                centerbias_dtype=centerbias_dtype, centerbias_factor=centerbias_factor,
+                decoded_images=decoded_images, processes=export_processes,
+            )
             self.lmdb_env = lmdb.open(lmdb_path, subdir=os.path.isdir(lmdb_path),
                 readonly=True, lock=False,
                 readahead=False, meminit=False
             )
-            cached = False
             cache_fixation_data = True
         else:
             self.lmdb_env = None
 
         self.cached = cached
-        if cached:
-            self._cache = {}
+        self.image_cache = _make_image_cache(len(self.stimuli), cache_bytes) if cached else None
         self.cache_fixation_data = cache_fixation_data
         if cache_fixation_data:
-            print("Populating fixations cache")
-            self._xs_cache = {}
-            self._ys_cache = {}
-
-            for x, y, n in zip(self.fixations.x_int, self.fixations.y_int, tqdm(self.fixations.n)):
-                self._xs_cache.setdefault(n, []).append(x)
-                self._ys_cache.setdefault(n, []).append(y)
-
-            for key in list(self._xs_cache):
-                self._xs_cache[key] = np.array(self._xs_cache[key], dtype=int)
-            for key in list(self._ys_cache):
-                self._ys_cache[key] = np.array(self._ys_cache[key], dtype=int)
+            # CSR index: fixations sorted by stimulus (keeping their order within each stimulus),
+            # the fixations of stimulus n are [offsets[n], offsets[n + 1])
+            ns = np.asarray(self.fixations.n)
+            order = np.argsort(ns, kind='stable')
+            self._fixation_xs = np.asarray(self.fixations.x_int)[order].astype(np.int32)
+            self._fixation_ys = np.asarray(self.fixations.y_int)[order].astype(np.int32)
+            self._fixation_offsets = np.searchsorted(ns[order], np.arange(len(self.stimuli) + 1))
 
     def get_shapes(self):
         return list(self.stimuli.sizes)
 
     def _get_image_data(self, n):
         if self.lmdb_env:
-            image, centerbias_prediction = _get_image_data_from_lmdb(self.lmdb_env, n)
+            image, centerbias_prediction = _get_image_data_from_lmdb(self.lmdb_env, n, downsample=self.downsample)
         else:
             image = np.array(self.stimuli.stimuli[n])
             centerbias_prediction = self.centerbias_model.log_density(image)
 
-            image = ensure_color_image(image).astype(np.float32)
+            # images stay uint8 until the model's input normalization
+            image = ensure_color_image(image)
+            if self.downsample != 1:
+                image = downsample_image(image, self.downsample)
             image = image.transpose(2, 0, 1)
 
         return image, centerbias_prediction
 
-    def __getitem__(self, key):
-        if not self.cached or key not in self._cache:
+    def _get_centerbias_data(self, n):
+        if self.lmdb_env:
+            return _NO_IMAGE, _get_centerbias_from_lmdb(self.lmdb_env, n)
+        return _NO_IMAGE, self.centerbias_model.log_density(self.stimuli.stimulus_objects[n])
 
-            image, centerbias_prediction = self._get_image_data(key)
+    def __getitem__(self, key):
+        # with cached features, only the centerbias is loaded (and cached)
+        load = self._get_image_data if self.feature_cache is None else self._get_centerbias_data
+        if self.image_cache is not None:
+            image, centerbias_prediction = self.image_cache.get_or_load(key, load)
+        else:
+            image, centerbias_prediction = load(key)
             centerbias_prediction = centerbias_prediction.astype(np.float32)
 
-            if self.cache_fixation_data and self.cached:
-                xs = self._xs_cache.pop(key)
-                ys = self._ys_cache.pop(key)
-            elif self.cache_fixation_data and not self.cached:
-                xs = self._xs_cache[key]
-                ys = self._ys_cache[key]
-            else:
-                inds = self.fixations.n == key
-                xs = np.array(self.fixations.x_int[inds], dtype=int)
-                ys = np.array(self.fixations.y_int[inds], dtype=int)
-
-            data = {
-                "image": image,
-                "x": xs,
-                "y": ys,
-                "centerbias": centerbias_prediction,
-            }
-
-            if self.average == 'image':
-                data['weight'] = 1.0
-            else:
-                data['weight'] = float(len(xs))
+        if self.cache_fixation_data:
+            start, stop = self._fixation_offsets[key], self._fixation_offsets[key + 1]
+            xs = self._fixation_xs[start:stop]
+            ys = self._fixation_ys[start:stop]
+        else:
+            inds = self.fixations.n == key
+            xs = np.array(self.fixations.x_int[inds], dtype=int)
+            ys = np.array(self.fixations.y_int[inds], dtype=int)
 
-            if self.cached:
-                self._cache[key] = data
+        data = {
+            "x": xs,
+            "y": ys,
+            "centerbias": centerbias_prediction,
+            "n": key,
+        }
+        if self.feature_cache is not None:
+            data['features'] = self.feature_cache[key]
+        else:
+            data['image'] = image
+
+        if self.average == 'image':
+            data['weight'] = 1.0
         else:
-            data = self._cache[key]
+            data['weight'] = float(len(xs))
 
         if self.transform is not None:
-            return self.transform(dict(data))
+            return self.transform(data)
 
         return data
 
@@ -163,21 +676,47 @@ class FixationDataset(torch.utils.data.Dataset):
         allow_missing_fixations=False,
         average='fixation',
         cache_image_data=False,
+        downsample=1,
+        cache_bytes=None,
+        feature_cache=None,
+        centerbias_dtype='float32',
+        centerbias_factor=1,
+        decoded_images=False,
+        export_processes=1,
     ):
+        """
+        Args:
+            cache_image_data (bool, optional): keep images and centerbias predictions in memory
+                (implied by `cache_bytes`, see `ImageDataset`)
+            downsample (int, optional): return images downsampled by this factor
+                (see `ImageDataset`)
+            cache_bytes (int, optional): byte budget of the shared image cache (see `ImageDataset`)
+            feature_cache (FeatureCache or str, optional): return cached backbone features
+                instead of images (see `ImageDataset`)
+            centerbias_dtype, centerbias_factor, decoded_images, export_processes (optional):
+                format and workers of the LMDB export (see `ImageDataset`)
+        """
         self.stimuli = stimuli
         self.fixations = fixations
         self.centerbias_model = centerbias_model
         self.lmdb_path = lmdb_path
+        self.downsample = downsample
+        self.feature_cache = _open_feature_cache(feature_cache, stimuli)
 
         if lmdb_path is not None:
-            _export_dataset_to_lmdb(stimuli, centerbias_model, lmdb_path)
+            export_dataset_to_lmdb(
+                stimuli, centerbias_model, lmdb_path,
+                centerbias_dtype=centerbias_dtype, centerbias_factor=centerbias_factor,
+                decoded_images=decoded_images, processes=export_processes,
+            )
             self.lmdb_env = lmdb.open(lmdb_path, subdir=os.path.isdir(lmdb_path),
                 readonly=True, lock=False,
                 readahead=False, meminit=False
             )
-            cache_image_data=False
+            cache_image_data = cache_bytes is not None
         else:
             self.lmdb_env = None
+            cache_image_data = cache_image_data or cache_bytes is not None
 
         self.transform = transform
         self.average = average
@@ -194,14 +733,13 @@ class FixationDataset(torch.utils.data.Dataset):
         self.allow_missing_fixations = allow_missing_fixations
         self.fixation_counts = Counter(fixations.n)
 
-        self.cache_image_data = cache_image_data
-
-        if self.cache_image_data:
-            self.image_data_cache = {}
+        # the history windows of all fixations, fetching an item only selects a row
+        self._x_hist, x_available = history_windows(self.fixations.x_hist, self.included_fixations)
+        self._y_hist, y_available = history_windows(self.fixations.y_hist, self.included_fixations)
+        self._history_complete = x_available.all(axis=1) & y_available.all(axis=1)
 
-            print("Populating image cache")
-            for n in tqdm(range(len(self.stimuli))):
-                self.image_data_cache[n] = self._get_image_data(n)
+        self.cache_image_data = cache_image_data
+        self.image_cache = _make_image_cache(len(self.stimuli), cache_bytes) if cache_image_data else None
 
     def get_shapes(self):
         if self._shapes is None:
@@ -212,53 +750,48 @@ class FixationDataset(torch.utils.data.Dataset):
 
     def _get_image_data(self, n):
         if self.lmdb_path:
-            return _get_image_data_from_lmdb(self.lmdb_env, n)
+            return _get_image_data_from_lmdb(self.lmdb_env, n, downsample=self.downsample)
         image = np.array(self.stimuli.stimuli[n])
         centerbias_prediction = self.centerbias_model.log_density(image)
 
-        image = ensure_color_image(image).astype(np.float32)
+        # images stay uint8 until the model's input normalization
+        image = ensure_color_image(image)
+        if self.downsample != 1:
+            image = downsample_image(image, self.downsample)
         image = image.transpose(2, 0, 1)
 
         return image, centerbias_prediction
 
+    def _get_centerbias_data(self, n):
+        if self.lmdb_path:
+            return _NO_IMAGE, _get_centerbias_from_lmdb(self.lmdb_env, n)
+        return _NO_IMAGE, self.centerbias_model.log_density(self.stimuli.stimulus_objects[n])
+
     def __getitem__(self, key):
         n = self.fixations.n[key]
 
-        if self.cache_image_data:
-            image, centerbias_prediction = self.image_data_cache[n]
-        else:
-            image, centerbias_prediction = self._get_image_data(n)
-
-        centerbias_prediction = centerbias_prediction.astype(np.float32)
-
-        x_hist = remove_trailing_nans(self.fixations.x_hist[key])
-        y_hist = remove_trailing_nans(self.fixations.y_hist[key])
-
-        if self.allow_missing_fixations:
-            _x_hist = []
-            _y_hist = []
-            for fixation_index in self.included_fixations:
-                if fixation_index < -len(x_hist):
-                    _x_hist.append(np.nan)
-                    _y_hist.append(np.nan)
-                else:
-                    _x_hist.append(x_hist[fixation_index])
-                    _y_hist.append(y_hist[fixation_index])
-            x_hist = np.array(_x_hist)
-            y_hist = np.array(_y_hist)
+        load = self._get_image_data if self.feature_cache is None else self._get_centerbias_data
+        if self.image_cache is not None:
+            image, centerbias_prediction = self.image_cache.get_or_load(n, load)
         else:
-            print("Not missing")
-            x_hist = x_hist[self.included_fixations]
-            y_hist = y_hist[self.included_fixations]
+            image, centerbias_prediction = load(n)
+            centerbias_prediction = centerbias_prediction.astype(np.float32)
+
+        if not self.allow_missing_fixations and not self._history_complete[key]:
+            raise IndexError("Fixation {} has not enough previous fixations, use allow_missing_fixations".format(key))
 
         data = {
-            "image": image,
             "x": np.array([self.fixations.x_int[key]], dtype=int),
             "y": np.array([self.fixations.y_int[key]], dtype=int),
-            "x_hist": x_hist,
-            "y_hist": y_hist,
+            "x_hist": self._x_hist[key],
+            "y_hist": self._y_hist[key],
             "centerbias": centerbias_prediction,
+            "n": int(n),
         }
+        if self.feature_cache is not None:
+            data['features'] = self.feature_cache[n]
+        else:
+            data['image'] = image
 
         if self.average == 'image':
             data['weight'] = 1.0 / self.fixation_counts[n]
@@ -274,31 +807,73 @@ class FixationDataset(torch.utils.data.Dataset):
         return len(self.fixations)
 
 
+def fixation_coordinates(xs, ys, width, height=None):
+    """Unique fixation locations of one image as int32 (y, x, count) rows.
+
+    Raises a ValueError for fixations outside of the image instead of wrapping them
+    into another row.
+    """
+    xs = np.asarray(xs, dtype=np.int64)
+    ys = np.asarray(ys, dtype=np.int64)
+    outside = (xs < 0) | (xs >= width) | (ys < 0)
+    if height is not None:
+        outside |= ys >= height
+    if outside.any():
+        index = np.flatnonzero(outside)[0]
+        raise ValueError("Fixation at x={}, y={} is outside of the {}x{} image".format(
+            xs[index], ys[index], width, height if height is not None else '?'))
+    locations, counts = np.unique(ys * width + xs, return_counts=True)
+    return np.stack([locations // width, locations % width, counts], axis=1).astype(np.int32)
+
+
 class FixationMaskTransform(object):
+    """Replaces the fixation `x` and `y` of an item by its `fixation_mask`.
+
+    With `sparse=True` the mask is an int32 array of (y, x, count) rows (see
+    `fixation_coordinates`) and batches have to be built with `collate_fixations`.
+    With `sparse=False` it is a dense int32 (height, width) tensor.
+    """
     def __init__(self, sparse=True):
         super().__init__()
         self.sparse = sparse
 
     def __call__(self, item):
-        shape = torch.Size([item['image'].shape[1], item['image'].shape[2]])
+        # the image might be downsampled, the centerbias has the full resolution
+        height, width = item['centerbias'].shape[0], item['centerbias'].shape[1]
         x = item.pop('x')
         y = item.pop('y')
 
-        # inds, values = x_y_to_sparse_indices(x, y)
-        inds = np.array([y, x])
-        values = np.ones(len(y), dtype=int)
-
-        mask = torch.sparse.IntTensor(torch.tensor(inds), torch.tensor(values), shape)
-        mask = mask.coalesce()
-        # sparse tensors don't work with workers...
-        if not self.sparse:
-            mask = mask.to_dense()
+        if self.sparse:
+            mask = fixation_coordinates(x, y, width, height)
+        else:
+            mask = torch.zeros((height, width), dtype=torch.int32)
+            mask.index_put_((torch.as_tensor(y, dtype=torch.int64), torch.as_tensor(x, dtype=torch.int64)),
+                            torch.ones(len(y), dtype=torch.int32), accumulate=True)
 
         item['fixation_mask'] = mask
 
         return item
 
 
+def collate_fixations(batch):
+    """`collate_fn` for items with (y, x, count) fixation masks from `FixationMaskTransform`.
+
+    The fixation masks of the batch are concatenated into one int32 tensor of
+    (batch_index, y, x, count) rows, all other entries are collated as usual.
+    """
+    masks = [item['fixation_mask'] for item in batch]
+    collated = torch.utils.data.default_collate([
+        {key: value for key, value in item.items() if key != 'fixation_mask'} for item in batch
+    ])
+
+    batch_indices = np.repeat(np.arange(len(masks), dtype=np.int32), [len(mask) for mask in masks])
+    collated['fixation_mask'] = torch.from_numpy(
+        np.concatenate([batch_indices[:, np.newaxis], np.concatenate(masks).reshape(-1, 3)], axis=1)
+    )
+
+    return collated
+
+
 class ImageDatasetSampler(torch.utils.data.Sampler):
     def __init__(self, data_source, batch_size=1, ratio_used=1.0, shuffle=True):
         self.ratio_used = ratio_used
@@ -333,71 +908,214 @@ class ImageDatasetSampler(torch.utils.data.Sampler):
         return int(self.ratio_used * len(self.batches))
 
 
-def _export_dataset_to_lmdb(stimuli: pysaliency.FileStimuli, centerbias_model: pysaliency.Model, lmdb_path, write_frequency=100):
+_export_worker_state = {}
+
+
+def _init_export_worker(stimuli, centerbias_model, encode_kwargs):
+    _export_worker_state['stimuli'] = stimuli
+    _export_worker_state['centerbias_model'] = centerbias_model
+    _export_worker_state['encode_kwargs'] = encode_kwargs
+
+
+def _encode_export_item(idx):
+    """Reads and encodes one stimulus (runs in the export workers)."""
+    stimuli = _export_worker_state['stimuli']
+    centerbias = _export_worker_state['centerbias_model'].log_density(stimuli[idx])
+    return idx, _encode_filestimulus_item(stimuli.filenames[idx], centerbias, **_export_worker_state['encode_kwargs'])
+
+
+def export_dataset_to_lmdb(stimuli: pysaliency.FileStimuli, centerbias_model: pysaliency.Model, lmdb_path, write_frequency=100,
+                           centerbias_dtype='float32', centerbias_factor=1, decoded_images=False,
+                           processes=None, chunksize=4):
+    """Writes images and centerbias predictions of `stimuli` into an LMDB, skipping existing records.
+
+    Centerbias predictions and file reads run in a pool of `processes` workers (default: number
+    of CPUs, 1 runs everything in this process); the records are written in order by this
+    process. Every `write_frequency` records are committed, so an interrupted export resumes
+    from the last commit.
+
+    Args:
+        centerbias_dtype (str, optional): dtype in which the centerbias is stored ('float16',
+            'float32' or 'float64'). The datasets use float32, so 'float32' is lossless.
+        centerbias_factor (int, optional): store the centerbias downsampled by this factor; it
+            is upsampled and renormalized on reading
+        decoded_images (bool, optional): store decoded uint8 pixels instead of the image files.
+            Records get larger, but reading them needs no image decoding.
+    """
     lmdb_path = os.path.expanduser(lmdb_path)
     isdir = os.path.isdir(lmdb_path)
 
-    print("Generate LMDB to %s" % lmdb_path)
     db = lmdb.open(lmdb_path, subdir=isdir,
                    map_size=1099511627776 * 2, readonly=False,
                    meminit=False, map_async=True)
 
-    txn = db.begin(write=True)
-    for idx, stimulus in enumerate(tqdm(stimuli)):
-        key = u'{}'.format(idx).encode('ascii')
-
-        previous_data = txn.get(key)
-        if previous_data:
-            continue
-
-        #timulus_data = stimulus.stimulus_data
-        stimulus_filename = stimuli.filenames[idx]
-        centerbias = centerbias_model.log_density(stimulus)
-
-        txn.put(
-            key,
-            _encode_filestimulus_item(stimulus_filename, centerbias)
-        )
-        if idx % write_frequency == 0:
-            #print("[%d/%d]" % (idx, len(stimuli)))
-            #print("stimulus ids", len(stimuli.stimulus_ids._cache))
-            #print("stimuli.cached", stimuli.cached)
-            #print("stimuli", len(stimuli.stimuli._cache))
-            #print("centerbias", len(centerbias_model._cache._cache))
-            txn.commit()
-            txn = db.begin(write=True)
-
-    # finish iterating through dataset
-    txn.commit()
-    #keys = [u'{}'.format(k).encode('ascii') for k in range(idx + 1)]
-    #with db.begin(write=True) as txn:
-    #    txn.put(b'__keys__', dumps_pyarrow(keys))
-    #    txn.put(b'__len__', dumps_pyarrow(len(keys)))
-
-    print("Flushing database ...")
-    db.sync()
-    db.close()
-
-
-def _encode_filestimulus_item(filename, centerbias):
+    with db.begin(write=False) as txn:
+        missing = [idx for idx in range(len(stimuli)) if txn.get(u'{}'.format(idx).encode('ascii')) is None]
+
+    if not missing:
+        db.close()
+        return
+
+    print("Generate LMDB to %s (%d of %d records missing)" % (lmdb_path, len(missing), len(stimuli)))
+
+    encode_kwargs = {
+        'centerbias_dtype': centerbias_dtype,
+        'centerbias_factor': centerbias_factor,
+        'decoded_image': decoded_images,
+    }
+    if processes is None:
+        processes = os.cpu_count()
+    processes = min(processes, len(missing))
+
+    if processes > 1:
+        pool = multiprocessing.Pool(processes, initializer=_init_export_worker,
+                                    initargs=(stimuli, centerbias_model, encode_kwargs))
+        items = pool.imap(_encode_export_item, missing, chunksize=chunksize)
+    else:
+        pool = None
+        _init_export_worker(stimuli, centerbias_model, encode_kwargs)
+        items = map(_encode_export_item, missing)
+
+    start_time = time.time()
+    written_items = 0
+    written_bytes = 0
+    try:
+        txn = db.begin(write=True)
+        for idx, record in tqdm(items, total=len(missing)):
+            txn.put(u'{}'.format(idx).encode('ascii'), record)
+            written_items += 1
+            written_bytes += len(record)
+            if written_items % write_frequency == 0:
+                txn.commit()
+                txn = db.begin(write=True)
+
+        # finish iterating through dataset
+        txn.commit()
+    finally:
+        if pool is not None:
+            pool.terminate()
+        _export_worker_state.clear()
+
+        print("Flushing database ...")
+        db.sync()
+        db.close()
+
+    duration = max(time.time() - start_time, 1e-9)
+    print("Wrote {} records ({:.1f} MB) in {:.1f}s: {:.1f} items/s, {:.1f} MB/s".format(
+        written_items, written_bytes / 1e6, duration, written_items / duration, written_bytes / 1e6 / duration,
+    ))
+
+
+# Binary LMDB records: header, image payload (padded to 8 bytes), centerbias payload.
+# Records written before the header was introduced are pickled dicts and are still readable.
+_RECORD_MAGIC = b'DGLM'
+_RECORD_VERSION = 1
+# magic, version, image encoding, centerbias dtype, image height, image width,
+# centerbias height, centerbias width, image payload size
+_RECORD_HEADER = struct.Struct('<4sHBBIIIIQ')
+_IMAGE_ENCODED = 0  # image file bytes
+_IMAGE_DECODED = 1  # uint8 pixels in (channels, height, width) order
+_CENTERBIAS_DTYPES = ['float16', 'float32', 'float64']
+
+
+def _encode_filestimulus_item(filename, centerbias, centerbias_dtype='float32', centerbias_factor=1, decoded_image=False):
     with open(filename, 'rb') as f:
         image_bytes = f.read()
 
-    buffer = io.BytesIO()
-    pickle.dump({'image': image_bytes, 'centerbias': centerbias}, buffer)
-    buffer.seek(0)
-    return buffer.read()
+    height, width = centerbias.shape
+
+    if decoded_image:
+        image = np.array(Image.open(io.BytesIO(image_bytes)).convert('RGB'))
+        image_payload = np.ascontiguousarray(image.transpose(2, 0, 1), dtype=np.uint8).tobytes()
+        image_encoding = _IMAGE_DECODED
+    else:
+        image_payload = image_bytes
+        image_encoding = _IMAGE_ENCODED
+
+    if centerbias_factor != 1:
+        centerbias = zoom(centerbias, 1 / centerbias_factor, order=1, mode='nearest')
+    centerbias_payload = np.ascontiguousarray(centerbias, dtype=centerbias_dtype).tobytes()
+
+    header = _RECORD_HEADER.pack(
+        _RECORD_MAGIC, _RECORD_VERSION, image_encoding, _CENTERBIAS_DTYPES.index(centerbias_dtype),
+        height, width, centerbias.shape[0], centerbias.shape[1], len(image_payload),
+    )
+    padding = b'\0' * (-(_RECORD_HEADER.size + len(image_payload)) % 8)
+
+    return header + image_payload + padding + centerbias_payload
+
+
+def _unpack_record_header(buffer):
+    header = _RECORD_HEADER.unpack_from(buffer)
+    if header[1] > _RECORD_VERSION:
+        raise ValueError("Unsupported LMDB record version {}".format(header[1]))
+    return header
+
+
+def _decode_record_centerbias(buffer, header):
+    (magic, version, image_encoding, centerbias_dtype, height, width,
+     centerbias_height, centerbias_width, image_size) = header
+    centerbias_offset = _RECORD_HEADER.size + image_size
+    centerbias_offset += -centerbias_offset % 8
+
+    centerbias = np.frombuffer(
+        buffer, dtype=_CENTERBIAS_DTYPES[centerbias_dtype],
+        count=centerbias_height * centerbias_width, offset=centerbias_offset,
+    ).reshape(centerbias_height, centerbias_width).astype(np.float32)
+    if (centerbias_height, centerbias_width) != (height, width):
+        # bilinear with aligned corners, like the `zoom` used when writing, but much faster
+        centerbias = torch.nn.functional.interpolate(
+            torch.from_numpy(centerbias)[None, None], size=(height, width), mode='bilinear', align_corners=True,
+        )[0, 0]
+        centerbias = (centerbias - centerbias.logsumexp(dim=(0, 1))).numpy()
+
+    return centerbias
+
+
+def _decode_record(buffer, downsample=1):
+    """Decodes a binary LMDB record. Arrays are copied out of `buffer`, which can be a view of the LMDB."""
+    header = _unpack_record_header(buffer)
+    image_encoding, height, width, image_size = header[2], header[4], header[5], header[8]
+    image_offset = _RECORD_HEADER.size
+
+    if image_encoding == _IMAGE_DECODED:
+        image = np.frombuffer(buffer, dtype=np.uint8, count=image_size, offset=image_offset).reshape(-1, height, width)
+        if downsample != 1:
+            image = np.ascontiguousarray(downsample_image(image.transpose(1, 2, 0), downsample).transpose(2, 0, 1))
+        else:
+            # `image` is still a view of `buffer`, which is only valid during the transaction
+            image = image.copy()
+    else:
+        image = decode_image(bytes(buffer[image_offset:image_offset + image_size]), downsample=downsample)
+        image = image.transpose(2, 0, 1)
+
+    return image, _decode_record_centerbias(buffer, header)
 
 
-def _get_image_data_from_lmdb(lmdb_env, n):
+def _get_image_data_from_lmdb(lmdb_env, n, downsample=1):
     key = '{}'.format(n).encode('ascii')
-    with lmdb_env.begin(write=False) as txn:
+    with lmdb_env.begin(write=False, buffers=True) as txn:
         byteflow = txn.get(key)
+        if byteflow[:len(_RECORD_MAGIC)] == _RECORD_MAGIC:
+            return _decode_record(byteflow, downsample=downsample)
+        byteflow = bytes(byteflow)
+
+    # records of databases written before the binary format
     data = pickle.loads(byteflow)
-    buffer = io.BytesIO(data['image'])
-    buffer.seek(0)
-    image = np.array(Image.open(buffer).convert('RGB'))
+    image = decode_image(data['image'], downsample=downsample)
     centerbias_prediction = data['centerbias']
     image = image.transpose(2, 0, 1)
 
-    return image, centerbias_prediction
\ No newline at end of file
+    return image, centerbias_prediction
+
+
+def _get_centerbias_from_lmdb(lmdb_env, n):
+    """Only the centerbias prediction of record `n`, without decoding the image."""
+    key = '{}'.format(n).encode('ascii')
+    with lmdb_env.begin(write=False, buffers=True) as txn:
+        byteflow = txn.get(key)
+        if byteflow[:len(_RECORD_MAGIC)] == _RECORD_MAGIC:
+            return _decode_record_centerbias(byteflow, _unpack_record_header(byteflow))
+        byteflow = bytes(byteflow)
+
+    return pickle.loads(byteflow)['centerbias']
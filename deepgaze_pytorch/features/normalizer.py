@@ -20,7 +20,11 @@ class Normalizer(nn.Module):
 
 
     def forward(self, tensor):
-        tensor = tensor / 255.0
+        if tensor.is_floating_point():
+            tensor = tensor / 255.0
+        else:
+            # uint8 images from the data loaders: cast and scale into a single new tensor
+            tensor = tensor.to(torch.get_default_dtype()).div_(255.0)
 
         tensor -= self.mean
         tensor /= self.std
@@ -21,7 +21,10 @@ class VGGInputNormalization(torch.nn.Module):
         self.register_buffer('std', torch.tensor(std))
 
     def forward(self, tensor):
-        if self.inplace:
+        if not tensor.is_floating_point():
+            # uint8 images from the data loaders: cast and scale into a single new tensor
+            tensor = tensor.to(torch.get_default_dtype()).div_(255.0)
+        elif self.inplace:
             tensor /= 255.0
         else:
             tensor = tensor / 255.0
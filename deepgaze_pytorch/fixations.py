@@ -0,0 +1,345 @@
+"""Fixation detection (I-VT, I-DT and their combinations) on raw gaze samples.
+
+All functions operate on numpy arrays of x and y sample coordinates recorded
+at a fixed `time_interval` (in seconds) and reproduce the labelling of the
+original loop-based implementation used by the visualizer apps.
+"""
+import numpy as np
+
+
+ALGORITHM_MODES = ['AND', 'OR', 'I-VT', 'I-DT']
+
+
+def calculate_velocity(x, y, time_interval):
+    """Point-to-point velocities, one entry per sample except the first.
+
+    Velocities are always computed in float64, so float32 samples (as in the
+    gaze store) cross the I-VT threshold at the same samples as parsed float64 ones.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    return np.sqrt(np.diff(x)**2 + np.diff(y)**2) / time_interval
+
+
+def label_runs(labels):
+    """Returns the start and (exclusive) end indices of all runs of nonzero labels."""
+    padded = np.concatenate(([False], np.asarray(labels, dtype=bool), [False]))
+    edges = np.flatnonzero(padded[1:] != padded[:-1])
+    return edges[0::2], edges[1::2]
+
+
+def runs_to_labels(starts, ends, length):
+    """Inverse of `label_runs`: boolean labels of the given length with the runs set."""
+    delta = np.zeros(length + 1, dtype=np.int64)
+    delta[starts] += 1
+    delta[ends] -= 1
+    return np.cumsum(delta[:-1]) > 0
+
+
+def _is_long_enough(starts, ends, time_interval, min_fixation_duration):
+    # keep the exact expression of the original implementation to get identical
+    # decisions for durations right at the threshold
+    return (ends - starts) * time_interval >= min_fixation_duration
+
+
+def ivt_segments(x, y, time_interval, velocity_threshold, min_fixation_duration):
+    """I-VT fixation segments as (starts, ends) sample indices.
+
+    A fixation is a run of samples that were reached with a velocity below
+    `velocity_threshold`. As in the original implementation, a run is only
+    closed by a fast sample, i.e. a run lasting until the end of the recording
+    is discarded.
+    """
+    velocities = calculate_velocity(x, y, time_interval)
+    starts, ends = label_runs(velocities < velocity_threshold)
+
+    keep = (ends < len(velocities)) & _is_long_enough(starts, ends, time_interval, min_fixation_duration)
+
+    # velocities[k] belongs to sample k + 1
+    return starts[keep] + 1, ends[keep] + 1
+
+
+def _dispersion_window_end(x, y, start, dispersion_threshold, initial_length=64):
+    """First index `j > start` at which x[start:j + 1] or y[start:j + 1] reaches the dispersion threshold.
+
+    The window grows from a fixed start, so running maxima and minima are
+    sufficient. They are evaluated on chunks of doubling size, which keeps the
+    total work linear in the window length.
+    """
+    length = initial_length
+    while True:
+        stop = min(start + length, len(x))
+        xs = x[start:stop]
+        ys = y[start:stop]
+        inside = (
+            (np.maximum.accumulate(xs) - np.minimum.accumulate(xs) < dispersion_threshold)
+            & (np.maximum.accumulate(ys) - np.minimum.accumulate(ys) < dispersion_threshold)
+        )
+        outside = np.flatnonzero(~inside)
+        if len(outside):
+            return start + outside[0]
+        if stop == len(x):
+            return stop
+        length *= 2
+
+
+def idt_segments(x, y, time_interval, dispersion_threshold, min_fixation_duration):
+    """I-DT fixation segments as (starts, ends) sample indices.
+
+    Greedily grows windows while both the horizontal and the vertical
+    dispersion stay below `dispersion_threshold` and keeps all windows lasting
+    at least `min_fixation_duration`.
+    """
+    x = np.asarray(x)
+    y = np.asarray(y)
+
+    starts = []
+    ends = []
+    i = 0
+    while i < len(x):
+        j = _dispersion_window_end(x, y, i, dispersion_threshold)
+        if j == i:
+            # a single sample already violates the threshold (non-positive threshold or NaN sample).
+            # The original implementation would loop forever here.
+            i += 1
+            continue
+        starts.append(i)
+        ends.append(j)
+        i = j
+
+    starts = np.array(starts, dtype=np.int64)
+    ends = np.array(ends, dtype=np.int64)
+    keep = _is_long_enough(starts, ends, time_interval, min_fixation_duration)
+
+    return starts[keep], ends[keep]
+
+
+def apply_ivt(x, y, time_interval, velocity_threshold, min_fixation_duration):
+    """Boolean I-VT fixation labels, one per sample."""
+    starts, ends = ivt_segments(x, y, time_interval, velocity_threshold, min_fixation_duration)
+    return runs_to_labels(starts, ends, len(x))
+
+
+def apply_idt(x, y, time_interval, dispersion_threshold, min_fixation_duration):
+    """Boolean I-DT fixation labels, one per sample."""
+    starts, ends = idt_segments(x, y, time_interval, dispersion_threshold, min_fixation_duration)
+    return runs_to_labels(starts, ends, len(x))
+
+
+def combine_labels(ivt_labels, idt_labels, algorithm_mode=0):
+    """Combines I-VT and I-DT labels according to `algorithm_mode` (see `ALGORITHM_MODES`)."""
+    if algorithm_mode == 0:
+        return np.logical_and(ivt_labels, idt_labels)
+    elif algorithm_mode == 1:
+        return np.logical_or(ivt_labels, idt_labels)
+    elif algorithm_mode == 2:
+        return np.asarray(ivt_labels, dtype=bool)
+    elif algorithm_mode == 3:
+        return np.asarray(idt_labels, dtype=bool)
+    else:
+        raise ValueError("Invalid algorithm mode. Use 0 (AND), 1 (OR), 2 (I-VT), or 3 (I-DT).")
+
+
+def _combine_segments(ivt, idt, length, algorithm_mode):
+    # going through the labels merges adjacent segments (e.g. consecutive I-DT windows) into one fixation
+    ivt_labels = runs_to_labels(*ivt, length) if ivt is not None else None
+    idt_labels = runs_to_labels(*idt, length) if idt is not None else None
+
+    return label_runs(combine_labels(ivt_labels, idt_labels, algorithm_mode))
+
+
+def _check_algorithm_mode(algorithm_mode):
+    if algorithm_mode not in range(len(ALGORITHM_MODES)):
+        raise ValueError("Invalid algorithm mode. Use 0 (AND), 1 (OR), 2 (I-VT), or 3 (I-DT).")
+
+
+def fixation_segments(x, y, time_interval, algorithm_mode=0, velocity_threshold=1000, dispersion_threshold=25, min_fixation_duration=0.1):
+    """Start and (exclusive) end sample indices of all detected fixations."""
+    _check_algorithm_mode(algorithm_mode)
+
+    ivt = None
+    idt = None
+    if algorithm_mode != 3:
+        ivt = ivt_segments(x, y, time_interval, velocity_threshold, min_fixation_duration)
+    if algorithm_mode != 2:
+        idt = idt_segments(x, y, time_interval, dispersion_threshold, min_fixation_duration)
+
+    return _combine_segments(ivt, idt, len(x), algorithm_mode)
+
+
+def segments_to_fixations(x, y, starts, ends):
+    """Converts fixation segments into sections of (x, y) samples and their centroids."""
+    points = np.column_stack((x, y))
+    fixation_sections = [points[start:end] for start, end in zip(starts, ends)]
+    # per-section means use the same (pairwise) summation as averaging the section samples directly
+    avg_x = np.array([np.mean(x[start:end]) for start, end in zip(starts, ends)], dtype=points.dtype)
+    avg_y = np.array([np.mean(y[start:end]) for start, end in zip(starts, ends)], dtype=points.dtype)
+
+    return fixation_sections, avg_x, avg_y
+
+
+def get_fixation(x, y, time_interval, algorithm_mode=0, velocity_threshold=1000, dispersion_threshold=25, min_fixation_duration=0.1):
+    """Detects fixations and returns their sections and average positions.
+
+    Args:
+        x, y (array): gaze sample coordinates in pixels
+        time_interval (float): time between two samples in seconds
+        algorithm_mode (int, optional): 0 (AND), 1 (OR), 2 (I-VT only) or 3 (I-DT only)
+        velocity_threshold (float, optional): I-VT velocity threshold in pixels/second
+        dispersion_threshold (float, optional): I-DT spatial dispersion threshold in pixels
+        min_fixation_duration (float, optional): minimum fixation duration in seconds
+
+    Returns:
+        fixation_sections: list of (n_i, 2) arrays with the samples of each fixation
+        avg_x, avg_y: arrays with the average position of each fixation
+    """
+    x = np.ascontiguousarray(x)
+    y = np.ascontiguousarray(y)
+
+    starts, ends = fixation_segments(
+        x, y, time_interval,
+        algorithm_mode=algorithm_mode,
+        velocity_threshold=velocity_threshold,
+        dispersion_threshold=dispersion_threshold,
+        min_fixation_duration=min_fixation_duration,
+    )
+
+    return segments_to_fixations(x, y, starts, ends)
+
+
+def _sparse_table(values, reduce):
+    """Range-extremum table: level k holds `reduce` over windows of length 2**k."""
+    levels = [values]
+    width = 1
+    while 2 * width <= len(values):
+        previous = levels[-1]
+        levels.append(reduce(previous[:-width], previous[width:]))
+        width *= 2
+    return levels
+
+
+class FixationSweep(object):
+    """Answers fixation detection queries for many thresholds on the same recording.
+
+    Velocities and sparse range-minimum/maximum tables over x and y are computed
+    once. Afterwards, each I-DT window is found by binary lifting over the
+    tables in O(log n), so a query costs O(number of windows * log n) on top of
+    a vectorized threshold comparison for I-VT. All queries return the same
+    result as `get_fixation` with the same parameters.
+    """
+
+    def __init__(self, x, y, time_interval):
+        self.x = np.ascontiguousarray(x)
+        self.y = np.ascontiguousarray(y)
+        self.time_interval = time_interval
+
+        self.velocities = calculate_velocity(self.x, self.y, time_interval)
+
+        self._x_max = _sparse_table(self.x, np.maximum)
+        self._x_min = _sparse_table(self.x, np.minimum)
+        self._y_max = _sparse_table(self.y, np.maximum)
+        self._y_min = _sparse_table(self.y, np.minimum)
+
+        self._ivt_cache = {}
+        self._idt_cache = {}
+
+    def __len__(self):
+        return len(self.x)
+
+    def _ivt_runs(self, velocity_threshold):
+        if velocity_threshold not in self._ivt_cache:
+            starts, ends = label_runs(self.velocities < velocity_threshold)
+            # runs lasting until the end of the recording are never closed (see `ivt_segments`)
+            closed = ends < len(self.velocities)
+            self._ivt_cache[velocity_threshold] = starts[closed] + 1, ends[closed] + 1
+        return self._ivt_cache[velocity_threshold]
+
+    def _window_end(self, start, dispersion_threshold):
+        end = start
+        x_max = x_min = self.x[start]
+        y_max = y_min = self.y[start]
+        for level in range(len(self._x_max) - 1, -1, -1):
+            if end + (1 << level) > len(self.x):
+                continue
+            new_x_max = np.maximum(x_max, self._x_max[level][end])
+            new_x_min = np.minimum(x_min, self._x_min[level][end])
+            new_y_max = np.maximum(y_max, self._y_max[level][end])
+            new_y_min = np.minimum(y_min, self._y_min[level][end])
+            if new_x_max - new_x_min < dispersion_threshold and new_y_max - new_y_min < dispersion_threshold:
+                end += 1 << level
+                x_max, x_min, y_max, y_min = new_x_max, new_x_min, new_y_max, new_y_min
+        return end
+
+    def _idt_windows(self, dispersion_threshold):
+        if dispersion_threshold not in self._idt_cache:
+            starts = []
+            ends = []
+            i = 0
+            while i < len(self.x):
+                j = self._window_end(i, dispersion_threshold)
+                if j == i:
+                    i += 1
+                    continue
+                starts.append(i)
+                ends.append(j)
+                i = j
+            self._idt_cache[dispersion_threshold] = np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64)
+        return self._idt_cache[dispersion_threshold]
+
+    def _filter_duration(self, segments, min_fixation_duration):
+        starts, ends = segments
+        keep = _is_long_enough(starts, ends, self.time_interval, min_fixation_duration)
+        return starts[keep], ends[keep]
+
+    def ivt_segments(self, velocity_threshold, min_fixation_duration):
+        return self._filter_duration(self._ivt_runs(velocity_threshold), min_fixation_duration)
+
+    def idt_segments(self, dispersion_threshold, min_fixation_duration):
+        return self._filter_duration(self._idt_windows(dispersion_threshold), min_fixation_duration)
+
+    def fixation_segments(self, algorithm_mode=0, velocity_threshold=1000, dispersion_threshold=25, min_fixation_duration=0.1):
+        """Same as the module level `fixation_segments` for this recording."""
+        _check_algorithm_mode(algorithm_mode)
+
+        ivt = None
+        idt = None
+        if algorithm_mode != 3:
+            ivt = self.ivt_segments(velocity_threshold, min_fixation_duration)
+        if algorithm_mode != 2:
+            idt = self.idt_segments(dispersion_threshold, min_fixation_duration)
+
+        return _combine_segments(ivt, idt, len(self), algorithm_mode)
+
+    def get_fixation(self, algorithm_mode=0, velocity_threshold=1000, dispersion_threshold=25, min_fixation_duration=0.1):
+        """Same as the module level `get_fixation` for this recording."""
+        starts, ends = self.fixation_segments(
+            algorithm_mode=algorithm_mode,
+            velocity_threshold=velocity_threshold,
+            dispersion_threshold=dispersion_threshold,
+            min_fixation_duration=min_fixation_duration,
+        )
+        return segments_to_fixations(self.x, self.y, starts, ends)
+
+    def sweep(self, velocity_thresholds, dispersion_thresholds, min_fixation_durations, algorithm_mode=0):
+        """Fixation segments for every combination of the given thresholds.
+
+        I-VT runs are computed once per velocity threshold and I-DT windows once
+        per dispersion threshold; the duration filter and the combination are
+        then applied per grid point.
+
+        Returns:
+            dict mapping (velocity_threshold, dispersion_threshold, min_fixation_duration)
+            to (starts, ends) arrays of sample indices.
+        """
+        results = {}
+        for velocity_threshold in velocity_thresholds:
+            for dispersion_threshold in dispersion_thresholds:
+                for min_fixation_duration in min_fixation_durations:
+                    key = (velocity_threshold, dispersion_threshold, min_fixation_duration)
+                    results[key] = self.fixation_segments(
+                        algorithm_mode=algorithm_mode,
+                        velocity_threshold=velocity_threshold,
+                        dispersion_threshold=dispersion_threshold,
+                        min_fixation_duration=min_fixation_duration,
+                    )
+        return results
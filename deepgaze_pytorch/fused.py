@@ -0,0 +1,366 @@
+"""Fused inference of the components of a `DeepGazeIIIMixture`.
+
+The components of a mixture all have the same small readout architecture
+(layer norms, 1x1 convolutions, biases, softplus and a `Finalizer`), and
+running them one after the other costs one kernel launch per layer and
+component. `FusedMixtureReadout` stacks the weights of all components and
+evaluates them together: activations of all components are kept as one
+batch x components x channels x height x width tensor, 1x1 convolutions become
+grouped convolutions, and the per-component gaussian blurs become one grouped
+convolution per spatial dimension.
+
+The first layer norm of a network that gets the same input for all components
+(the backbone features) is normalized once, its per-component affine
+transformation is folded into the weights of the following convolution.
+
+The fused readout is a snapshot of the component weights: it has no
+parameters of its own and has to be rebuilt after the weights change.
+"""
+import math
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from .layers import (
+    Bias,
+    Conv2dMultiInput,
+    FlexibleScanpathHistoryEncoding,
+    LayerNorm,
+    LayerNormMultiInput,
+)
+
+
+def _stack(tensors):
+    return torch.stack([tensor.detach() for tensor in tensors])
+
+
+def _check_equal(layers, *attributes):
+    for attribute in attributes:
+        values = {repr(getattr(layer, attribute)) for layer in layers}
+        if len(values) > 1:
+            raise ValueError("Cannot fuse {} layers with different {}: {}".format(type(layers[0]).__name__, attribute, values))
+
+
+def _check_pointwise(convolutions):
+    for convolution in convolutions:
+        if convolution.kernel_size != (1, 1) or convolution.stride != (1, 1) or convolution.groups != 1:
+            raise ValueError("Only 1x1 convolutions can be fused, got {}".format(convolution))
+
+
+class _Softplus(nn.Module):
+    def __init__(self, layers):
+        super().__init__()
+        _check_equal(layers, 'beta', 'threshold')
+        self.beta = layers[0].beta
+        self.threshold = layers[0].threshold
+
+    def forward(self, x):
+        return F.softplus(x, self.beta, self.threshold)
+
+
+class _StackedLayerNorm(nn.Module):
+    """Layer norms of all components on stacked activations."""
+
+    def __init__(self, layers):
+        super().__init__()
+        _check_equal(layers, 'eps', 'features')
+        self.eps = layers[0].eps
+        self.register_buffer('weight', _stack([layer.weight for layer in layers]), persistent=False)
+        self.register_buffer('bias', _stack([layer.bias for layer in layers]), persistent=False)
+
+    def forward(self, x):
+        x = F.layer_norm(x, x.shape[2:], eps=self.eps)
+        return torch.addcmul(self.bias[:, :, np.newaxis, np.newaxis], x, self.weight[:, :, np.newaxis, np.newaxis])
+
+
+class _SharedLayerNormConv(nn.Module):
+    """Layer norms followed by 1x1 convolutions on an input shared by all components.
+
+    The input is normalized once, the affine parameters of the layer norms are
+    folded into the convolution weights.
+    """
+
+    def __init__(self, layer_norms, convolutions):
+        super().__init__()
+        _check_equal(layer_norms, 'eps', 'features')
+        _check_pointwise(convolutions)
+        self.eps = layer_norms[0].eps
+
+        weight = _stack([convolution.weight[:, :, 0, 0] for convolution in convolutions])  # components x out x in
+        norm_weight = _stack([layer_norm.weight for layer_norm in layer_norms])
+        norm_bias = _stack([layer_norm.bias for layer_norm in layer_norms])
+
+        bias = torch.einsum('koc,kc->ko', weight, norm_bias)
+        if convolutions[0].bias is not None:
+            bias = bias + _stack([convolution.bias for convolution in convolutions])
+
+        self.components, self.out_channels = weight.shape[:2]
+        weight = weight * norm_weight[:, np.newaxis, :]
+        self.register_buffer('weight', weight.reshape(-1, weight.shape[2], 1, 1), persistent=False)
+        self.register_buffer('bias', bias.reshape(-1), persistent=False)
+
+    def forward(self, x):
+        x = F.layer_norm(x, x.shape[1:], eps=self.eps)
+        x = F.conv2d(x, self.weight, self.bias)
+        return x.view(x.shape[0], self.components, self.out_channels, x.shape[2], x.shape[3])
+
+
+class _StackedConv(nn.Module):
+    """1x1 convolutions of all components on stacked activations as one grouped convolution."""
+
+    def __init__(self, convolutions):
+        super().__init__()
+        _check_pointwise(convolutions)
+        weight = _stack([convolution.weight for convolution in convolutions])
+        self.components, self.out_channels = weight.shape[:2]
+        self.register_buffer('weight', weight.reshape(-1, *weight.shape[2:]), persistent=False)
+        if convolutions[0].bias is not None:
+            self.register_buffer('bias', _stack([convolution.bias for convolution in convolutions]).reshape(-1), persistent=False)
+        else:
+            self.bias = None
+
+    def forward(self, x):
+        batch_size, components, channels, height, width = x.shape
+        x = F.conv2d(x.reshape(batch_size, components * channels, height, width), self.weight, self.bias, groups=components)
+        return x.view(batch_size, components, self.out_channels, height, width)
+
+
+class _SharedConv(nn.Module):
+    """Convolutions of all components on an input shared by all components."""
+
+    def __init__(self, convolutions):
+        super().__init__()
+        _check_equal(convolutions, 'kernel_size', 'stride', 'padding', 'dilation', 'groups')
+        self.stride = convolutions[0].stride
+        self.padding = convolutions[0].padding
+        self.dilation = convolutions[0].dilation
+        self.groups = convolutions[0].groups
+        weight = _stack([convolution.weight for convolution in convolutions])
+        self.components, self.out_channels = weight.shape[:2]
+        self.register_buffer('weight', weight.reshape(-1, *weight.shape[2:]), persistent=False)
+        if convolutions[0].bias is not None:
+            self.register_buffer('bias', _stack([convolution.bias for convolution in convolutions]).reshape(-1), persistent=False)
+        else:
+            self.bias = None
+
+    def forward(self, x):
+        x = F.conv2d(x, self.weight, self.bias, stride=self.stride, padding=self.padding, dilation=self.dilation, groups=self.groups)
+        return x.view(x.shape[0], self.components, self.out_channels, x.shape[2], x.shape[3])
+
+
+class _StackedBias(nn.Module):
+    def __init__(self, layers):
+        super().__init__()
+        self.register_buffer('bias', _stack([layer.bias for layer in layers]), persistent=False)
+
+    def forward(self, x):
+        return x + self.bias[:, :, np.newaxis, np.newaxis]
+
+
+class _SharedScanpathHistoryEncoding(nn.Module):
+    """`FlexibleScanpathHistoryEncoding` of all components on the shared scanpath features."""
+
+    def __init__(self, layers):
+        super().__init__()
+        _check_equal(layers, 'in_fixations', 'channels_per_fixation', 'out_channels')
+        self.in_fixations = layers[0].in_fixations
+        self.convolutions = nn.ModuleList([
+            _SharedConv([layer.convolutions[fixation_index] for layer in layers])
+            for fixation_index in range(self.in_fixations)
+        ])
+
+    def forward(self, tensor):
+        results = None
+        valid_fixations = ~torch.isnan(tensor[:, :self.in_fixations, 0, 0])
+
+        for fixation_index in range(self.in_fixations):
+            valid_indices = valid_fixations[:, fixation_index]
+            if not torch.any(valid_indices):
+                continue
+            this_result = self.convolutions[fixation_index](tensor[valid_indices, fixation_index::self.in_fixations])
+            if results is None:
+                results = this_result.new_zeros((tensor.shape[0],) + this_result.shape[1:])
+            results[valid_indices] += this_result
+
+        return results
+
+
+class _StackedLayerNormMultiInput(nn.Module):
+    def __init__(self, layers):
+        super().__init__()
+        _check_equal(layers, 'features')
+        self.parts = nn.ModuleList([
+            _StackedLayerNorm([getattr(layer, f'layernorm_part{k}') for layer in layers]) if count else None
+            for k, count in enumerate(layers[0].features)
+        ])
+
+    def forward(self, tensors):
+        return [part(tensor) if part is not None else None for part, tensor in zip(self.parts, tensors)]
+
+
+class _StackedConvMultiInput(nn.Module):
+    def __init__(self, layers):
+        super().__init__()
+        _check_equal(layers, 'in_channels', 'out_channels')
+        self.parts = nn.ModuleList([
+            _StackedConv([getattr(layer, f'conv_part{k}') for layer in layers]) if count else None
+            for k, count in enumerate(layers[0].in_channels)
+        ])
+
+    def forward(self, tensors):
+        out = None
+        for part, tensor in zip(self.parts, tensors):
+            if part is None:
+                continue
+            _out = part(tensor)
+            out = _out if out is None else out + _out
+        return out
+
+
+def _fuse_sequential(networks, shared_input):
+    """Fused layers for the sequential `networks` of all components.
+
+    Args:
+        shared_input (bool): whether all components get the same (unstacked) input
+    """
+    component_layers = [list(network) for network in networks]
+    if len({len(layers) for layers in component_layers}) > 1:
+        raise ValueError("Cannot fuse networks of different depth")
+
+    fused_layers = []
+    position = 0
+    while position < len(component_layers[0]):
+        layers = [component[position] for component in component_layers]
+        layer_type = type(layers[0])
+        if any(type(layer) is not layer_type for layer in layers):
+            raise ValueError("Cannot fuse different layers at position {}".format(position))
+
+        next_layers = [component[position + 1] for component in component_layers] if position + 1 < len(component_layers[0]) else None
+
+        if shared_input and layer_type is LayerNorm and next_layers is not None and all(type(layer) is nn.Conv2d for layer in next_layers):
+            fused_layers.append(_SharedLayerNormConv(layers, next_layers))
+            position += 1
+        elif shared_input and layer_type is nn.Conv2d:
+            fused_layers.append(_SharedConv(layers))
+        elif shared_input and layer_type is FlexibleScanpathHistoryEncoding:
+            fused_layers.append(_SharedScanpathHistoryEncoding(layers))
+        elif layer_type is nn.Softplus:
+            fused_layers.append(_Softplus(layers))
+            position += 1
+            continue
+        elif shared_input:
+            raise ValueError("Cannot fuse {} on the shared input".format(layer_type.__name__))
+        elif layer_type is LayerNorm:
+            fused_layers.append(_StackedLayerNorm(layers))
+        elif layer_type is nn.Conv2d:
+            fused_layers.append(_StackedConv(layers))
+        elif layer_type is Bias:
+            fused_layers.append(_StackedBias(layers))
+        elif layer_type is LayerNormMultiInput:
+            fused_layers.append(_StackedLayerNormMultiInput(layers))
+        elif layer_type is Conv2dMultiInput:
+            fused_layers.append(_StackedConvMultiInput(layers))
+        else:
+            raise ValueError("Cannot fuse {} layers".format(layer_type.__name__))
+
+        shared_input = False
+        position += 1
+
+    return nn.Sequential(*fused_layers)
+
+
+class _FusedFinalizer(nn.Module):
+    """The `Finalizer`s of all components, with one grouped gaussian blur per spatial dimension."""
+
+    def __init__(self, finalizers):
+        super().__init__()
+        _check_equal(finalizers, 'saliency_map_factor')
+        _check_equal([finalizer.gauss for finalizer in finalizers], 'truncate', 'kernel_size', 'padding_mode', 'padding_value')
+        gauss = finalizers[0].gauss
+        self.saliency_map_factor = finalizers[0].saliency_map_factor
+        self.padding_mode = gauss.padding_mode
+        self.padding_value = gauss.padding_value
+
+        # the same kernels as `layers.gaussian_filter_1d`, zero padded to the largest kernel size
+        sigmas = [float(finalizer.gauss.sigma.detach()) for finalizer in finalizers]
+        if gauss.kernel_size is not None:
+            kernel_sizes = [int(gauss.kernel_size)] * len(sigmas)
+        else:
+            kernel_sizes = [2 * math.ceil(gauss.truncate * sigma) + 1 for sigma in sigmas]
+        max_kernel_size = max(kernel_sizes)
+        kernels = torch.zeros((len(sigmas), 1, max_kernel_size), dtype=torch.float64)
+        for k, (sigma, kernel_size) in enumerate(zip(sigmas, kernel_sizes)):
+            grid = torch.arange(kernel_size, dtype=torch.float64) - (kernel_size - 1) / 2
+            kernel = torch.exp(-0.5 * (grid / sigma) ** 2)
+            start = (max_kernel_size - kernel_size) // 2
+            kernels[k, 0, start:start + kernel_size] = kernel / kernel.sum()
+
+        self.padding = math.ceil((max_kernel_size - 1) / 2)
+        self.register_buffer('kernels', kernels.to(torch.float32), persistent=False)
+        self.register_buffer('center_bias_weights', _stack([finalizer.center_bias_weight[0] for finalizer in finalizers]), persistent=False)
+
+    def _blur(self, tensor, dim):
+        # components as channels of a grouped 1d convolution along `dim`
+        batch_size, components = tensor.shape[:2]
+        tensor = torch.movedim(tensor, dim, -1)
+        moved_shape = tensor.shape
+        tensor = torch.movedim(tensor, 1, -2).reshape(-1, components, moved_shape[-1])
+        tensor = F.pad(tensor, (self.padding, self.padding), self.padding_mode, self.padding_value)
+        tensor = F.conv1d(tensor, self.kernels.to(tensor.dtype), groups=components)
+        tensor = torch.movedim(tensor.view(batch_size, *moved_shape[2:-1], components, moved_shape[-1]), -2, 1)
+        return torch.movedim(tensor, -1, dim)
+
+    def forward(self, readout, centerbias):
+        """Log densities of all components (batch x components x height x width)"""
+        downscaled_centerbias = F.interpolate(
+            centerbias.view(centerbias.shape[0], 1, centerbias.shape[1], centerbias.shape[2]),
+            scale_factor=1 / self.saliency_map_factor,
+            recompute_scale_factor=False,
+        )[:, 0, :, :]
+
+        out = F.interpolate(
+            readout[:, :, 0, :, :],
+            size=[downscaled_centerbias.shape[1], downscaled_centerbias.shape[2]]
+        )
+
+        out = self._blur(out, 2)
+        out = self._blur(out, 3)
+
+        out = out + self.center_bias_weights[np.newaxis, :, np.newaxis, np.newaxis] * downscaled_centerbias[:, np.newaxis, :, :]
+
+        out = F.interpolate(out, size=[centerbias.shape[1], centerbias.shape[2]])
+
+        return out - out.logsumexp(dim=(2, 3), keepdim=True)
+
+
+class FusedMixtureReadout(nn.Module):
+    """Evaluates all components of a `DeepGazeIIIMixture` from the backbone features in one pass.
+
+    Build it with `DeepGazeIIIMixture.fuse_components`. It holds a copy of the
+    component weights as non persistent buffers, so it follows `.to()` but doesn't
+    change the state dict of the model.
+    """
+
+    def __init__(self, saliency_networks, scanpath_networks, fixation_selection_networks, finalizers):
+        super().__init__()
+        self.components = len(saliency_networks)
+
+        self.saliency_network = _fuse_sequential(saliency_networks, shared_input=True)
+
+        with_scanpath = [scanpath_network is not None for scanpath_network in scanpath_networks]
+        if any(with_scanpath) and not all(with_scanpath):
+            raise ValueError("Cannot fuse components with and without scanpath network")
+        self.scanpath_network = _fuse_sequential(scanpath_networks, shared_input=True) if all(with_scanpath) else None
+
+        self.fixation_selection_network = _fuse_sequential(fixation_selection_networks, shared_input=False)
+        self.finalizer = _FusedFinalizer(finalizers)
+
+    def forward(self, readout_input, centerbias, scanpath_features=None):
+        x = self.saliency_network(readout_input)
+        y = self.scanpath_network(scanpath_features) if self.scanpath_network is not None else None
+        x = self.fixation_selection_network((x, y))
+        predictions = self.finalizer(x, centerbias) - np.log(self.components)
+
+        return predictions.logsumexp(dim=1, keepdim=True)
@@ -96,47 +96,58 @@ class LayerNorm(nn.Module):
             nn.init.zeros_(self.bias)
 
     def adjust_parameter(self, tensor, parameter):
-        return torch.repeat_interleave(
-            torch.repeat_interleave(
-                parameter.view(-1, 1, 1),
-                repeats=tensor.shape[2],
-                dim=1),
-            repeats=tensor.shape[3],
-            dim=2
-        )
+        """Per channel `parameter` as a view that broadcasts over the spatial dimensions of `tensor`."""
+        return parameter.view(-1, 1, 1)
 
     def forward(self, input):
         normalized_shape = (self.features, input.shape[2], input.shape[3])
-        weight = self.adjust_parameter(input, self.weight)
-        bias = self.adjust_parameter(input, self.bias)
-        return F.layer_norm(
-            input, normalized_shape, weight, bias, self.eps)
+        # normalize without affine parameters and apply them by broadcasting instead of
+        # expanding them to the full input size; addcmul matches F.layer_norm's affine step
+        output = F.layer_norm(input, normalized_shape, None, None, self.eps)
+        if self.scale and self.center:
+            return torch.addcmul(self.adjust_parameter(input, self.bias), output, self.adjust_parameter(input, self.weight))
+        if self.scale:
+            return output * self.adjust_parameter(input, self.weight)
+        if self.center:
+            return output + self.adjust_parameter(input, self.bias)
+        return output
 
     def extra_repr(self):
         return '{features}, eps={eps}, ' \
             'center={center}, scale={scale}'.format(**self.__dict__)
 
 
-def gaussian_filter_1d(tensor, dim, sigma, truncate=4, kernel_size=None, padding_mode='replicate', padding_value=0.0):
-    sigma = torch.as_tensor(sigma, device=tensor.device, dtype=tensor.dtype)
+#: kernels of at least this size are applied with FFTs instead of direct convolution
+FFT_KERNEL_SIZE = 65
 
-    if kernel_size is not None:
-        kernel_size = torch.as_tensor(kernel_size, device=tensor.device, dtype=torch.int64)
-    else:
-        kernel_size = torch.as_tensor(2 * torch.ceil(truncate * sigma) + 1, device=tensor.device, dtype=torch.int64)
 
-    kernel_size = kernel_size.detach()
+def gaussian_kernel_size(sigma, truncate=4, dtype=torch.float32):
+    """Size of the gaussian kernel for `sigma` (synchronizes with the device if `sigma` is a tensor)."""
+    if isinstance(sigma, torch.Tensor):
+        return int((2 * torch.ceil(truncate * sigma.detach().to(dtype)) + 1).item())
+    return 2 * math.ceil(truncate * sigma) + 1
 
-    kernel_size_int = kernel_size.detach().cpu().numpy()
 
-    mean = (torch.as_tensor(kernel_size, dtype=tensor.dtype) - 1) / 2
+def gaussian_kernel_1d(sigma, kernel_size, dtype=torch.float32, device=None):
+    """Normalized gaussian kernel of `kernel_size` taps; differentiable with respect to `sigma`."""
+    sigma = torch.as_tensor(sigma, device=device, dtype=dtype)
+    mean = (torch.as_tensor(kernel_size, dtype=dtype) - 1) / 2
+    grid = torch.arange(kernel_size, device=device) - mean.to(device)
 
-    grid = torch.arange(kernel_size, device=tensor.device) - mean
+    kernel = torch.exp(-0.5 * (grid / sigma) ** 2)
+    return kernel / kernel.sum()
 
-    kernel_shape = (1, 1, kernel_size)
-    grid = grid.view(kernel_shape)
 
-    grid = grid.detach()
+def filter_1d(tensor, dim, kernel, padding_mode='replicate', padding_value=0.0, fft=None):
+    """Convolves `tensor` along `dim` with a symmetric 1d `kernel`, keeping the size of `tensor`.
+
+    Args:
+        fft (bool, optional): convolve via FFTs, which is faster for large kernels
+            (default: for kernels with at least `FFT_KERNEL_SIZE` taps)
+    """
+    kernel_size = kernel.shape[-1]
+    if fft is None:
+        fft = kernel_size >= FFT_KERNEL_SIZE
 
     source_shape = tensor.shape
 
@@ -147,16 +158,18 @@ def gaussian_filter_1d(tensor, dim, sigma, truncate=4, kernel_size=None, padding
     # we need reshape instead of view for batches like B x C x H x W
     tensor = tensor.reshape(-1, 1, source_shape[dim])
 
-    padding = (math.ceil((kernel_size_int - 1) / 2), math.ceil((kernel_size_int - 1) / 2))
+    padding = (math.ceil((kernel_size - 1) / 2), math.ceil((kernel_size - 1) / 2))
     tensor_ = F.pad(tensor, padding, padding_mode, padding_value)
 
-    # create gaussian kernel from grid using current sigma
-    kernel = torch.exp(-0.5 * (grid / sigma) ** 2)
-    kernel = kernel / kernel.sum()
+    if fft:
+        # linear convolution of the padded input; the kernel is symmetric, so this equals conv1d's correlation
+        n = tensor_.shape[-1] + kernel_size - 1
+        tensor_ = torch.fft.irfft(torch.fft.rfft(tensor_, n=n) * torch.fft.rfft(kernel, n=n), n=n)
+        tensor_ = tensor_[..., kernel_size - 1:kernel_size - 1 + source_shape[dim]]
+    else:
+        tensor_ = F.conv1d(tensor_, kernel.view(1, 1, kernel_size))
 
-    # convolve input with gaussian kernel
-    tensor_ = F.conv1d(tensor_, kernel)
-    tensor_ = tensor_.view(dim_last_shape)
+    tensor_ = tensor_.reshape(dim_last_shape)
     tensor_ = torch.movedim(tensor_, len(source_shape)-1, dim)
 
     assert tensor_.shape == source_shape
@@ -164,11 +177,20 @@ def gaussian_filter_1d(tensor, dim, sigma, truncate=4, kernel_size=None, padding
     return tensor_
 
 
+def gaussian_filter_1d(tensor, dim, sigma, truncate=4, kernel_size=None, padding_mode='replicate', padding_value=0.0, fft=None):
+    if kernel_size is None:
+        kernel_size = gaussian_kernel_size(sigma, truncate=truncate, dtype=tensor.dtype)
+
+    kernel = gaussian_kernel_1d(sigma, int(kernel_size), dtype=tensor.dtype, device=tensor.device)
+
+    return filter_1d(tensor, dim, kernel, padding_mode=padding_mode, padding_value=padding_value, fft=fft)
+
+
 class GaussianFilterNd(nn.Module):
     """A differentiable gaussian filter"""
 
     def __init__(self, dims, sigma, truncate=4, kernel_size=None, padding_mode='replicate', padding_value=0.0,
-                 trainable=False):
+                 trainable=False, fft=None):
         """Creates a 1d gaussian filter
 
         Args:
@@ -181,6 +203,7 @@ class GaussianFilterNd(nn.Module):
             kernel_size (int): size of the gaussian kernel convolved with the input
             padding_mode (string, optional): Padding mode implemented by `torch.nn.functional.pad`.
             padding_value (string, optional): Value used for constant padding.
+            fft (bool, optional): filter via FFTs (default: for kernels of at least `FFT_KERNEL_SIZE` taps)
         """
         # IDEA determine input_dims dynamically for every input
         super(GaussianFilterNd, self).__init__()
@@ -189,22 +212,55 @@ class GaussianFilterNd(nn.Module):
         self.sigma = nn.Parameter(torch.tensor(sigma, dtype=torch.float32), requires_grad=trainable)  # default: no optimization
         self.truncate = truncate
         self.kernel_size = kernel_size
+        self.fft = fft
 
         # setup padding
         self.padding_mode = padding_mode
         self.padding_value = padding_value
 
+        # (dtype, device) -> (sigma version, kernel size, kernel)
+        self._kernels = {}
+
+    def _sigma_version(self):
+        # changes whenever sigma is updated in place (optimizer steps, load_state_dict) or replaced
+        return (self.sigma.data_ptr(), self.sigma._version)
+
+    def kernel(self, dtype, device):
+        """The gaussian kernel for the current sigma.
+
+        The kernel is cached per dtype and device until sigma changes, so repeated
+        calls don't synchronize with the device. While sigma is trained, the kernel
+        is rebuilt (from the cached kernel size) in every call to stay differentiable.
+        """
+        key = (dtype, device)
+        version = self._sigma_version()
+        cached = self._kernels.get(key)
+        if cached is None or cached[0] != version:
+            if self.kernel_size is not None:
+                kernel_size = int(self.kernel_size)
+            else:
+                kernel_size = gaussian_kernel_size(self.sigma, truncate=self.truncate, dtype=dtype)
+            with torch.no_grad():
+                kernel = gaussian_kernel_1d(self.sigma, kernel_size, dtype=dtype, device=device)
+            cached = (version, kernel_size, kernel)
+            self._kernels[key] = cached
+
+        _, kernel_size, kernel = cached
+        if self.sigma.requires_grad and torch.is_grad_enabled():
+            return gaussian_kernel_1d(self.sigma, kernel_size, dtype=dtype, device=device)
+        return kernel
+
     def forward(self, tensor):
         """Applies the gaussian filter to the given tensor"""
+        kernel = self.kernel(tensor.dtype, tensor.device)
         for dim in self.dims:
-            tensor = gaussian_filter_1d(
+            tensor = filter_1d(
                 tensor,
                 dim=dim,
-                sigma=self.sigma,
-                truncate=self.truncate,
-                kernel_size=self.kernel_size,
+                kernel=kernel,
                 padding_mode=self.padding_mode,
                 padding_value=self.padding_value,
+                fft=self.fft,
             )
 
         return tensor
@@ -1,69 +1,491 @@
+from functools import cached_property
+
 import numpy as np
-from pysaliency.roc import general_roc
-from pysaliency.numba_utils import auc_for_one_positive
 import torch
 
+from .layers import gaussian_filter_1d
+
 
-def _general_auc(positives, negatives):
-    if len(positives) == 1:
-        return auc_for_one_positive(positives[0], negatives)
+def fixation_coordinates(fixation_mask):
+    """(batch_index, y, x, count) of all fixated pixels as int64 tensors.
+
+    `fixation_mask` can be a dense (batch, height, width) tensor, a sparse tensor or an
+    (N, 4) tensor of (batch_index, y, x, count) rows as built by `data.collate_fixations`.
+    """
+    if fixation_mask.is_sparse:
+        fixation_mask = fixation_mask.coalesce()
+        coordinates = torch.cat([fixation_mask.indices(), fixation_mask.values()[None]], dim=0).T
+    elif fixation_mask.dim() == 2:
+        coordinates = fixation_mask
     else:
-        return general_roc(positives, negatives)[0]
+        indices = fixation_mask.nonzero(as_tuple=True)
+        coordinates = torch.stack(indices + (fixation_mask[indices],), dim=1)
 
+    batch_index, y, x, count = coordinates.long().unbind(dim=1)
+    return batch_index, y, x, count
 
-def log_likelihood(log_density, fixation_mask, weights=None):
-    #if weights is None:
-    #    weights = torch.ones(log_density.shape[0])
 
-    weights = len(weights) * weights.view(-1, 1, 1) / weights.sum()
+#: standard deviation in pixels of the gaussian used to build empirical fixation densities
+EMPIRICAL_DENSITY_SIGMA = 35.0
 
-    if isinstance(fixation_mask, torch.sparse.IntTensor):
-        dense_mask = fixation_mask.to_dense()
-    else:
-        dense_mask = fixation_mask
-    fixation_count = dense_mask.sum(dim=(-1, -2), keepdim=True)
-    ll = torch.mean(
-        weights * torch.sum(log_density * dense_mask, dim=(-1, -2), keepdim=True) / fixation_count
-    )
+METRICS = ['LL', 'IG', 'NSS', 'AUC', 'sAUC', 'CC', 'KLDiv', 'SIM']
+
+
+class ShuffledNegatives(object):
+    """Fixed negatives of the shuffled AUC: the fixations on all stimuli of a dataset.
+
+    As in `pysaliency` (`nonfixations='shuffled'`), an image is scored against the
+    fixations on all other stimuli, rescaled from the size of their stimulus to the
+    size of the image.
+
+    Args:
+        x, y (array): fixation positions in pixels of their stimulus
+        n (array): stimulus index of each fixation
+        widths, heights (array): size of the stimulus of each fixation
+    """
+
+    def __init__(self, x, y, n, widths, heights):
+        self.x = torch.as_tensor(np.asarray(x, dtype=np.float64))
+        self.y = torch.as_tensor(np.asarray(y, dtype=np.float64))
+        self.n = torch.as_tensor(np.asarray(n, dtype=np.int64))
+        self.widths = torch.as_tensor(np.asarray(widths, dtype=np.float64))
+        self.heights = torch.as_tensor(np.asarray(heights, dtype=np.float64))
+        self._coordinates = {}
+
+    @classmethod
+    def from_fixations(cls, stimuli, fixations):
+        """Negatives from all `fixations` on `stimuli` (pysaliency objects)."""
+        sizes = np.array([size[:2] for size in stimuli.sizes])
+        n = np.asarray(fixations.n)
+        return cls(fixations.x, fixations.y, n, sizes[n, 1], sizes[n, 0])
+
+    def __len__(self):
+        return len(self.n)
+
+    def coordinates(self, height, width, device=None):
+        """Stimulus index, y and x of all negatives on an image of the given size."""
+        key = height, width, str(device)
+        if key not in self._coordinates:
+            # same arithmetic as pysaliency, so the pixels match exactly
+            y = (self.y * (height / self.heights)).long()
+            x = (self.x * (width / self.widths)).long()
+            self._coordinates[key] = self.n.to(device), y.to(device), x.to(device)
+        return self._coordinates[key]
+
+
+class _BatchIntermediates(object):
+    """Lazily computed quantities shared by the metrics of one batch."""
+
+    def __init__(self, log_density, fixation_mask, baseline_log_density=None, empirical_sigma=EMPIRICAL_DENSITY_SIGMA,
+                 stimulus_ids=None, shuffled_negatives=None):
+        self.log_density = log_density
+        self.fixation_mask = fixation_mask
+        self.baseline_log_density = baseline_log_density
+        self.empirical_sigma = empirical_sigma
+        self.stimulus_ids = stimulus_ids
+        self.shuffled_negatives = shuffled_negatives
+
+    @cached_property
+    def coordinates(self):
+        return fixation_coordinates(self.fixation_mask)
+
+    @cached_property
+    def counts(self):
+        return self.coordinates[3].to(self.log_density.dtype)
+
+    @cached_property
+    def fixation_counts(self):
+        """Number of fixations per image."""
+        batch_index = self.coordinates[0]
+        return self.log_density.new_zeros(self.log_density.shape[0]).index_add_(0, batch_index, self.counts)
+
+    @cached_property
+    def density(self):
+        return torch.exp(self.log_density)
+
+    @cached_property
+    def density_moments(self):
+        """Per image (std, mean) of the density over pixels."""
+        return torch.std_mean(self.density, dim=(-1, -2))
+
+    @cached_property
+    def empirical_density(self):
+        """Fixation counts blurred with a gaussian of `empirical_sigma` pixels, normalized per image."""
+        batch_index, y, x, _ = self.coordinates
+        fixation_map = torch.zeros_like(self.log_density, dtype=self.counts.dtype)
+        fixation_map.index_put_((batch_index, y, x), self.counts, accumulate=True)
+        for dim in (-2, -1):
+            fixation_map = gaussian_filter_1d(
+                fixation_map, dim=fixation_map.dim() + dim, sigma=self.empirical_sigma,
+                padding_mode='constant', padding_value=0.0,
+            )
+        return fixation_map / fixation_map.sum(dim=(-1, -2), keepdim=True)
+
+    def fixation_mean(self, values):
+        """Mean of the per fixated pixel `values` for each image, weighted by the fixation counts."""
+        batch_index = self.coordinates[0]
+        image_sums = self.log_density.new_zeros(self.log_density.shape[0]).index_add_(0, batch_index, values * self.counts)
+        return image_sums / self.fixation_counts
+
+
+def _image_log_likelihoods(intermediates, log_density):
+    """Per image log-likelihoods in bit per fixation relative to a uniform density."""
+    batch_index, y, x, _ = intermediates.coordinates
+    ll = intermediates.fixation_mean(log_density[batch_index, y, x])
     return (ll + np.log(log_density.shape[-1] * log_density.shape[-2])) / np.log(2)
 
 
-def nss(log_density, fixation_mask, weights=None):
-    weights = len(weights) * weights.view(-1, 1, 1) / weights.sum()
-    if isinstance(fixation_mask, torch.sparse.IntTensor):
-        dense_mask = fixation_mask.to_dense()
+def _image_ll(intermediates):
+    return _image_log_likelihoods(intermediates, intermediates.log_density)
+
+
+def _image_ig(intermediates):
+    if intermediates.baseline_log_density is None:
+        raise ValueError("IG needs a baseline log density")
+    return _image_ll(intermediates) - _image_log_likelihoods(intermediates, intermediates.baseline_log_density)
+
+
+def _image_nss(intermediates):
+    batch_index, y, x, _ = intermediates.coordinates
+    std, mean = intermediates.density_moments
+    saliency = (intermediates.density[batch_index, y, x] - mean[batch_index]) / std[batch_index]
+    return intermediates.fixation_mean(saliency)
+
+
+def _image_auc(intermediates):
+    values = intermediates.log_density.detach().flatten(start_dim=1)
+    pixel_count = values.shape[1]
+    sorted_values, order = torch.sort(values, dim=1)
+
+    # number of pixels with lower value (start of the group of ties) and with
+    # lower or equal value (end of the group of ties) for each sorted pixel
+    positions = torch.arange(pixel_count, device=values.device).expand_as(values)
+    changes = sorted_values[:, 1:] != sorted_values[:, :-1]
+    boundary = changes.new_ones((values.shape[0], 1))
+    lower = torch.where(torch.cat([boundary, changes], dim=1), positions, 0).cummax(dim=1).values
+    lower_or_equal = torch.where(
+        torch.cat([changes, boundary], dim=1), positions + 1, pixel_count
+    ).flip(1).cummin(dim=1).values.flip(1)
+
+    # fraction of pixels with lower value plus half the fraction of pixels with the same value
+    scores = torch.empty_like(values).scatter_(1, order, (lower + lower_or_equal).to(values.dtype) / (2 * pixel_count))
+
+    batch_index, y, x, _ = intermediates.coordinates
+    return intermediates.fixation_mean(scores[batch_index, y * intermediates.log_density.shape[-1] + x])
+
+
+def _image_sauc(intermediates):
+    batch_index, y, x, _ = intermediates.coordinates
+    log_density = intermediates.log_density.detach()
+    batch_size = log_density.shape[0]
+    stimulus_ids = intermediates.stimulus_ids
+
+    if intermediates.shuffled_negatives is not None:
+        if stimulus_ids is None:
+            raise ValueError("sAUC with shuffled_negatives needs the stimulus_ids of the batch")
+        negative_ids, negative_y, negative_x = intermediates.shuffled_negatives.coordinates(
+            log_density.shape[-2], log_density.shape[-1], device=log_density.device,
+        )
+        negative_weights = (negative_ids != stimulus_ids[:, np.newaxis]).to(log_density.dtype)
     else:
-        dense_mask = fixation_mask
+        # the fixations on the other images (other stimuli, if known) of the batch
+        negative_y, negative_x = y, x
+        if stimulus_ids is None:
+            image_ids = torch.arange(batch_size, device=log_density.device)
+        else:
+            image_ids = stimulus_ids
+        negative_weights = intermediates.counts * (image_ids[batch_index] != image_ids[:, np.newaxis])
 
-    fixation_count = dense_mask.sum(dim=(-1, -2), keepdim=True)
+    # value of every negative on every image of the batch: images x negatives
+    values = log_density[:, negative_y, negative_x]
+    sorted_values, order = torch.sort(values, dim=1)
+    cumulative_weights = torch.cat([
+        negative_weights.new_zeros((batch_size, 1)), negative_weights.gather(1, order).cumsum(dim=1),
+    ], dim=1)
 
-    density = torch.exp(log_density)
-    mean, std = torch.std_mean(density, dim=(-1, -2), keepdim=True)
-    saliency_map = (density - mean) / std
+    # weight of the negatives with lower and with lower or equal value for each fixated pixel
+    positives = log_density[batch_index, y, x].expand(batch_size, -1).contiguous()
+    lower = cumulative_weights.gather(1, torch.searchsorted(sorted_values, positives))
+    lower_or_equal = cumulative_weights.gather(1, torch.searchsorted(sorted_values, positives, right=True))
+    fixations = torch.arange(len(batch_index), device=log_density.device)
+    scores = (lower + lower_or_equal)[batch_index, fixations] / (2 * cumulative_weights[batch_index, -1])
 
-    nss = torch.mean(
-        weights * torch.sum(saliency_map * dense_mask, dim=(-1, -2), keepdim=True) / fixation_count
-    )
-    return nss
+    # images without any negatives get NaN and are left out of the batch average
+    return intermediates.fixation_mean(scores)
 
 
-def auc(log_density, fixation_mask, weights=None):
+def _image_cc(intermediates):
+    std, mean = intermediates.density_moments
+    empirical_std, empirical_mean = torch.std_mean(intermediates.empirical_density, dim=(-1, -2))
+    covariance = torch.sum(
+        (intermediates.density - mean[:, np.newaxis, np.newaxis]) * (intermediates.empirical_density - empirical_mean[:, np.newaxis, np.newaxis]),
+        dim=(-1, -2),
+    ) / (intermediates.density[0].numel() - 1)
+    return covariance / (std * empirical_std)
+
+
+def _image_kldiv(intermediates):
+    """KL divergence of the model density from the empirical density in nats."""
+    empirical_density = intermediates.empirical_density
+    return torch.sum(torch.xlogy(empirical_density, empirical_density) - empirical_density * intermediates.log_density, dim=(-1, -2))
+
+
+def _image_sim(intermediates):
+    density = intermediates.density / intermediates.density.sum(dim=(-1, -2), keepdim=True)
+    return torch.sum(torch.minimum(density, intermediates.empirical_density), dim=(-1, -2))
+
+
+_IMAGE_METRICS = {
+    'LL': _image_ll,
+    'IG': _image_ig,
+    'NSS': _image_nss,
+    'AUC': _image_auc,
+    'sAUC': _image_sauc,
+    'CC': _image_cc,
+    'KLDiv': _image_kldiv,
+    'SIM': _image_sim,
+}
+
+
+def saliency_metrics(log_density, fixation_mask, weights, metrics=None, baseline_log_density=None,
+                     empirical_sigma=EMPIRICAL_DENSITY_SIGMA, stimulus_ids=None, shuffled_negatives=None):
+    """Computes several metrics of a batch of predictions at once.
+
+    Intermediate results (fixation coordinates, the density and its moments, the
+    empirical fixation density) are computed once and shared between the metrics.
+
+    Args:
+        log_density (tensor): batch x height x width log densities
+        fixation_mask (tensor): fixations as accepted by `fixation_coordinates`
+        weights (tensor): weight of each image in the batch average
+        metrics (list, optional): names from `METRICS` (default: all metrics
+            that are possible with the given arguments)
+        baseline_log_density (tensor, optional): log densities of a baseline model, needed for `IG`
+        empirical_sigma (float, optional): size in pixels of the gaussian blur for the empirical
+            fixation densities used by `CC`, `KLDiv` and `SIM`
+        stimulus_ids (tensor, optional): stimulus index of each image (the `n` of the dataset items)
+        shuffled_negatives (ShuffledNegatives, optional): fixed negatives for `sAUC`
+
+    With `shuffled_negatives` (and `stimulus_ids`), `sAUC` scores every image against the
+    fixations on all other stimuli of the dataset, which gives the same values as
+    `pysaliency`. Without them, the negatives are the fixations on the other stimuli of
+    the batch (the other images, if `stimulus_ids` is not given). These batch-local scores
+    depend on the batch composition and are not comparable to `pysaliency`; images without
+    negatives are left out of the `sAUC` average. `KLDiv` is given in nats, `LL` and `IG`
+    in bit per fixation.
+
+    Returns:
+        dict: metric name -> weighted batch average
+    """
+    if metrics is None:
+        metrics = [metric for metric in METRICS if metric != 'IG' or baseline_log_density is not None]
+
     weights = len(weights) * weights / weights.sum()
+    intermediates = _BatchIntermediates(log_density, fixation_mask, baseline_log_density=baseline_log_density,
+                                        empirical_sigma=empirical_sigma, stimulus_ids=stimulus_ids,
+                                        shuffled_negatives=shuffled_negatives)
 
-    # TODO: This doesn't account for multiple fixations in the same location!
-    def image_auc(log_density, fixation_mask):
-        if isinstance(fixation_mask, torch.sparse.IntTensor):
-            dense_mask = fixation_mask.to_dense()
+    results = {}
+    for metric in metrics:
+        scores = _IMAGE_METRICS[metric](intermediates)
+        if metric == 'sAUC':
+            scored = ~torch.isnan(scores)
+            if not scored.any():
+                raise ValueError("sAUC needs shuffled_negatives or fixations on more than one stimulus in the batch")
+            results[metric] = torch.sum(weights[scored] * scores[scored]) / torch.sum(weights[scored])
         else:
-            dense_mask = fixation_mask
+            results[metric] = torch.mean(weights * scores)
+
+    return results
+
+
+def log_likelihood(log_density, fixation_mask, weights=None):
+    #if weights is None:
+    #    weights = torch.ones(log_density.shape[0])
+    return saliency_metrics(log_density, fixation_mask, weights, metrics=['LL'])['LL']
+
+
+def nss(log_density, fixation_mask, weights=None):
+    return saliency_metrics(log_density, fixation_mask, weights, metrics=['NSS'])['NSS']
+
+
+def auc(log_density, fixation_mask, weights=None):
+    """Area under the ROC curve of the fixated pixels against all pixels of the image.
+
+    Pixels fixated several times count as several positives, ties count one half,
+    as in `pysaliency.roc.general_roc`. All images of the batch are ranked with one
+    sort, so everything stays on the device of `log_density`.
+    """
+    return saliency_metrics(log_density, fixation_mask, weights, metrics=['AUC'])['AUC']
+
+
+def shuffled_auc(log_density, fixation_mask, weights=None, stimulus_ids=None, shuffled_negatives=None):
+    """AUC of the fixations of each image against the fixations on other stimuli (see `saliency_metrics`)."""
+    return saliency_metrics(log_density, fixation_mask, weights, metrics=['sAUC'], stimulus_ids=stimulus_ids,
+                            shuffled_negatives=shuffled_negatives)['sAUC']
+
+
+def correlation_coefficient(log_density, fixation_mask, weights=None, empirical_sigma=EMPIRICAL_DENSITY_SIGMA):
+    return saliency_metrics(log_density, fixation_mask, weights, metrics=['CC'], empirical_sigma=empirical_sigma)['CC']
+
+
+def kl_divergence(log_density, fixation_mask, weights=None, empirical_sigma=EMPIRICAL_DENSITY_SIGMA):
+    return saliency_metrics(log_density, fixation_mask, weights, metrics=['KLDiv'], empirical_sigma=empirical_sigma)['KLDiv']
+
+
+def similarity(log_density, fixation_mask, weights=None, empirical_sigma=EMPIRICAL_DENSITY_SIGMA):
+    return saliency_metrics(log_density, fixation_mask, weights, metrics=['SIM'], empirical_sigma=empirical_sigma)['SIM']
+
+
+def information_gain(log_density, fixation_mask, baseline_log_density, weights=None):
+    return saliency_metrics(log_density, fixation_mask, weights, metrics=['IG'], baseline_log_density=baseline_log_density)['IG']
+
+
+class MetricAccumulator(object):
+    """Weighted running average of a metric.
+
+    Accumulators of different shards of a dataset can be merged (`merge` or `+`)
+    and give exactly the weighted average over the whole dataset.
+    """
+
+    def __init__(self, weighted_sum=0.0, weight=0.0):
+        self.weighted_sum = weighted_sum
+        self.weight = weight
+
+    def update(self, value, weight=1.0):
+        self.weighted_sum += float(value) * float(weight)
+        self.weight += float(weight)
+
+    def merge(self, other):
+        self.weighted_sum += other.weighted_sum
+        self.weight += other.weight
+        return self
+
+    def __add__(self, other):
+        return type(self)(self.weighted_sum, self.weight).merge(other)
+
+    @property
+    def value(self):
+        return self.weighted_sum / self.weight if self.weight else np.nan
+
+    def state_dict(self):
+        return {'weighted_sum': self.weighted_sum, 'weight': self.weight}
+
+    @classmethod
+    def from_state_dict(cls, state_dict):
+        return cls(**state_dict)
+
+
+class AUCHistogramAccumulator(object):
+    """Dataset level AUC from weighted histograms of the fixated and of all pixel values.
+
+    Values are log densities relative to a uniform density, so that images of
+    different sizes share the bins. Each image contributes its image weight to
+    both histograms. Ties within a bin count one half, so the result is exact up
+    to the bin resolution. Histograms of different shards are merged by adding them.
+    """
+
+    def __init__(self, bins=4096, value_range=(-20.0, 12.0)):
+        self.value_range = value_range
+        self.positives = np.zeros(bins)
+        self.negatives = np.zeros(bins)
+
+    def _histogram(self, values, weights):
+        bins = len(self.positives)
+        low, high = self.value_range
+        indices = ((values - low) * (bins / (high - low))).long().clamp_(0, bins - 1)
+        histogram = weights.new_zeros(bins).index_add_(0, indices, weights)
+        return histogram.double().cpu().numpy()
+
+    def update(self, log_density, fixation_mask, weights):
+        log_density = log_density.detach()
+        values = log_density + np.log(log_density.shape[-1] * log_density.shape[-2])
+        weights = weights.to(log_density.dtype)
+
+        batch_index, y, x, count = fixation_coordinates(fixation_mask)
+        count = count.to(log_density.dtype)
+        fixation_counts = log_density.new_zeros(log_density.shape[0]).index_add_(0, batch_index, count)
+
+        self.positives += self._histogram(values[batch_index, y, x], (weights / fixation_counts)[batch_index] * count)
+        pixel_weights = (weights / values[0].numel())[:, np.newaxis].expand(-1, values[0].numel())
+        self.negatives += self._histogram(values.flatten(), pixel_weights.flatten())
+
+    def merge(self, other):
+        self.positives += other.positives
+        self.negatives += other.negatives
+        return self
+
+    def __add__(self, other):
+        result = type(self)(bins=len(self.positives), value_range=self.value_range)
+        return result.merge(self).merge(other)
+
+    @property
+    def value(self):
+        lower_negatives = np.cumsum(self.negatives) - self.negatives
+        return np.sum(self.positives * (lower_negatives + 0.5 * self.negatives)) / (self.positives.sum() * self.negatives.sum())
+
+    def state_dict(self):
+        return {'positives': self.positives, 'negatives': self.negatives, 'value_range': self.value_range}
+
+    @classmethod
+    def from_state_dict(cls, state_dict):
+        accumulator = cls(bins=len(state_dict['positives']), value_range=tuple(state_dict['value_range']))
+        accumulator.positives += state_dict['positives']
+        accumulator.negatives += state_dict['negatives']
+        return accumulator
+
+
+class MetricAccumulators(object):
+    """Streaming evaluation of `saliency_metrics` over many batches.
+
+    Keeps one `MetricAccumulator` per metric (weighted by the summed image weights
+    of each batch, as the epoch averages did before) and optionally the
+    `AUCHistogramAccumulator` for the dataset level `pooledAUC`. Each update costs
+    O(1) in the number of batches seen so far; accumulators of shards merge exactly.
+    """
+
+    def __init__(self, metrics=None, pooled_auc=False):
+        self.metrics = {metric: MetricAccumulator() for metric in metrics or []}
+        self.pooled_auc = AUCHistogramAccumulator() if pooled_auc else None
+
+    def update(self, scores, weights, log_density=None, fixation_mask=None):
+        """Adds the batch averages `scores` (metric name -> value) of a batch with image `weights`."""
+        batch_weight = float(weights.sum())
+        for metric, score in scores.items():
+            self.metrics.setdefault(metric, MetricAccumulator()).update(score, batch_weight)
+        if self.pooled_auc is not None:
+            self.pooled_auc.update(log_density, fixation_mask, weights)
+
+    def merge(self, other):
+        for metric, accumulator in other.metrics.items():
+            self.metrics.setdefault(metric, MetricAccumulator()).merge(accumulator)
+        if other.pooled_auc is not None:
+            if self.pooled_auc is None:
+                self.pooled_auc = AUCHistogramAccumulator(bins=len(other.pooled_auc.positives), value_range=other.pooled_auc.value_range)
+            self.pooled_auc.merge(other.pooled_auc)
+        return self
 
-        positives = torch.masked_select(log_density, dense_mask.type(torch.bool)).detach().cpu().numpy().astype(np.float64)
-        negatives = log_density.flatten().detach().cpu().numpy().astype(np.float64)
+    def __getitem__(self, metric):
+        if metric == 'pooledAUC':
+            return self.pooled_auc
+        return self.metrics[metric]
 
-        auc = _general_auc(positives, negatives)
+    def values(self):
+        data = {metric: accumulator.value for metric, accumulator in self.metrics.items()}
+        if self.pooled_auc is not None:
+            data['pooledAUC'] = self.pooled_auc.value
+        return data
 
-        return torch.tensor(auc)
+    def state_dict(self):
+        return {
+            'metrics': {metric: accumulator.state_dict() for metric, accumulator in self.metrics.items()},
+            'pooled_auc': self.pooled_auc.state_dict() if self.pooled_auc is not None else None,
+        }
 
-    return torch.mean(weights.cpu() * torch.tensor([
-        image_auc(log_density[i], fixation_mask[i]) for i in range(log_density.shape[0])
-    ]))
+    @classmethod
+    def from_state_dict(cls, state_dict):
+        accumulators = cls()
+        accumulators.metrics = {metric: MetricAccumulator.from_state_dict(state) for metric, state in state_dict['metrics'].items()}
+        if state_dict['pooled_auc'] is not None:
+            accumulators.pooled_auc = AUCHistogramAccumulator.from_state_dict(state_dict['pooled_auc'])
+        return accumulators
@@ -1,4 +1,5 @@
 import functools
+import itertools
 import math
 
 import numpy as np
@@ -6,10 +7,26 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from .fused import FusedMixtureReadout
 from .layers import GaussianFilterNd
 
 
-def encode_scanpath_features(x_hist, y_hist, size, device=None, include_x=True, include_y=True, include_duration=False):
+def nearest_sample_positions(length, output_length, device=None):
+    """Positions out of `range(length)` that nearest neighbour `F.interpolate` samples for `output_length` outputs."""
+    positions = torch.arange(length, dtype=torch.float32, device=device)
+    if output_length is None:
+        return positions
+    # interpolating the positions themselves picks exactly the same source pixels
+    return F.interpolate(positions.view(1, 1, 1, length), size=(1, output_length))[0, 0, 0]
+
+
+def encode_scanpath_features(x_hist, y_hist, size, device=None, include_x=True, include_y=True, include_duration=False, output_size=None):
+    """Per fixation x and y offsets and distances of all pixels to the previous fixations.
+
+    With `output_size`, the features are evaluated only at the pixels that
+    `F.interpolate(features, output_size)` would sample, which gives the same
+    result without building the features at full resolution `size`.
+    """
     assert include_x
     assert include_y
     assert not include_duration
@@ -17,36 +34,48 @@ def encode_scanpath_features(x_hist, y_hist, size, device=None, include_x=True,
     height = size[0]
     width = size[1]
 
-    xs = torch.arange(width, dtype=torch.float32).to(device)
-    ys = torch.arange(height, dtype=torch.float32).to(device)
-    YS, XS = torch.meshgrid(ys, xs, indexing='ij')
-
-    XS = torch.repeat_interleave(
-        torch.repeat_interleave(
-            XS[np.newaxis, np.newaxis, :, :],
-            repeats=x_hist.shape[0],
-            dim=0,
-        ),
-        repeats=x_hist.shape[1],
-        dim=1,
-    )
-
-    YS = torch.repeat_interleave(
-        torch.repeat_interleave(
-            YS[np.newaxis, np.newaxis, :, :],
-            repeats=y_hist.shape[0],
-            dim=0,
-        ),
-        repeats=y_hist.shape[1],
-        dim=1,
-    )
-
-    XS -= x_hist.unsqueeze(2).unsqueeze(3)
-    YS -= y_hist.unsqueeze(2).unsqueeze(3)
+    if output_size is None:
+        output_size = (None, None)
+
+    xs = nearest_sample_positions(width, output_size[1], device=device)
+    ys = nearest_sample_positions(height, output_size[0], device=device)
+
+    # the offsets are float32 as the previously used in-place subtraction from a float32 grid
+    XS = (xs[np.newaxis, np.newaxis, np.newaxis, :] - x_hist.unsqueeze(2).unsqueeze(3)).to(torch.float32)
+    YS = (ys[np.newaxis, np.newaxis, :, np.newaxis] - y_hist.unsqueeze(2).unsqueeze(3)).to(torch.float32)
 
     distances = torch.sqrt(XS**2 + YS**2)
 
-    return torch.cat((XS, YS, distances), axis=1)
+    return torch.cat((XS.expand_as(distances), YS.expand_as(distances), distances), axis=1)
+
+def downsampled_size(size, downsample):
+    """Spatial size of an input of `size` after `F.interpolate(x, scale_factor=1 / downsample)`."""
+    return tuple(int(math.floor(dim * (1 / downsample))) for dim in size)
+
+
+def downsample_input(x, centerbias, downsample, **kwargs):
+    """Downsamples the model input by `downsample` unless the data pipeline already did.
+
+    Inputs of the size of the centerbias are interpolated (keyword arguments are passed to
+    `F.interpolate`), inputs of the downsampled size (see `data.ImageDataset`'s `downsample`)
+    are used as they are.
+
+    Returns:
+        x: the downsampled input
+        orig_shape: shape of the full resolution input
+    """
+    orig_shape = (x.shape[0], x.shape[1], centerbias.shape[1], centerbias.shape[2])
+    if tuple(x.shape[2:]) == tuple(centerbias.shape[1:]):
+        x = F.interpolate(x, scale_factor=1 / downsample, **kwargs)
+    elif tuple(x.shape[2:]) != downsampled_size(centerbias.shape[1:], downsample):
+        raise ValueError(f"Input of size {tuple(x.shape[2:])} is neither the size of the centerbias {tuple(centerbias.shape[1:])} nor downsampled by {downsample}")
+    return x, orig_shape
+
+
+def readout_size(size, downsample, readout_factor):
+    """Spatial size of the readout for an input of full resolution `size`."""
+    return [math.ceil(size[0] / downsample / readout_factor), math.ceil(size[1] / downsample / readout_factor)]
+
 
 class FeatureExtractor(torch.nn.Module):
     def __init__(self, features, targets):
@@ -182,24 +211,29 @@ class DeepGazeII(torch.nn.Module):
         )
         self.downsample = downsample
 
-    def forward(self, x, centerbias):
-        orig_shape = x.shape
-        x = F.interpolate(
-            x,
-            scale_factor=1 / self.downsample,
-            recompute_scale_factor=False,
-        )
+    def extract_features(self, x, centerbias):
+        """Backbone features at readout resolution, the input of `forward_features`.
+
+        The backbone is frozen, so these can be computed once per stimulus
+        (see `data.build_feature_cache`).
+        """
+        x, orig_shape = downsample_input(x, centerbias, self.downsample, recompute_scale_factor=False)
         x = self.features(x)
 
-        readout_shape = [math.ceil(orig_shape[2] / self.downsample / self.readout_factor), math.ceil(orig_shape[3] / self.downsample / self.readout_factor)]
+        readout_shape = readout_size(orig_shape[2:], self.downsample, self.readout_factor)
         x = [F.interpolate(item, readout_shape) for item in x]
 
-        x = torch.cat(x, dim=1)
+        return torch.cat(x, dim=1)
+
+    def forward_features(self, x, centerbias):
         x = self.readout_network(x)
         x = self.finalizer(x, centerbias)
 
         return x
 
+    def forward(self, x, centerbias):
+        return self.forward_features(self.extract_features(x, centerbias), centerbias)
+
     def train(self, mode=True):
         self.features.eval()
         self.readout_network.train(mode=mode)
@@ -231,21 +265,25 @@ class DeepGazeIII(torch.nn.Module):
             saliency_map_factor=self.saliency_map_factor,
         )
 
-    def forward(self, x, centerbias, x_hist=None, y_hist=None, durations=None):
-        orig_shape = x.shape
-        x = F.interpolate(x, scale_factor=1 / self.downsample)
+    def extract_features(self, x, centerbias):
+        """Backbone features at readout resolution, the input of `forward_features`."""
+        x, orig_shape = downsample_input(x, centerbias, self.downsample)
         x = self.features(x)
 
-        readout_shape = [math.ceil(orig_shape[2] / self.downsample / self.readout_factor), math.ceil(orig_shape[3] / self.downsample / self.readout_factor)]
+        readout_shape = readout_size(orig_shape[2:], self.downsample, self.readout_factor)
         x = [F.interpolate(item, readout_shape) for item in x]
 
-        x = torch.cat(x, dim=1)
+        return torch.cat(x, dim=1)
+
+    def forward(self, x, centerbias, x_hist=None, y_hist=None, durations=None):
+        return self.forward_features(self.extract_features(x, centerbias), centerbias, x_hist=x_hist, y_hist=y_hist, durations=durations)
+
+    def forward_features(self, x, centerbias, x_hist=None, y_hist=None, durations=None):
+        readout_shape = list(x.shape[2:])
         x = self.saliency_network(x)
 
         if self.scanpath_network is not None:
-            scanpath_features = encode_scanpath_features(x_hist, y_hist, size=(orig_shape[2], orig_shape[3]), device=x.device)
-            #scanpath_features = F.interpolate(scanpath_features, scale_factor=1 / self.downsample / self.readout_factor)
-            scanpath_features = F.interpolate(scanpath_features, readout_shape)
+            scanpath_features = encode_scanpath_features(x_hist, y_hist, size=(centerbias.shape[1], centerbias.shape[2]), device=x.device, output_size=readout_shape)
             y = self.scanpath_network(scanpath_features)
         else:
             y = None
@@ -285,24 +323,74 @@ class DeepGazeIIIMixture(torch.nn.Module):
         self.fixation_selection_networks = torch.nn.ModuleList(fixation_selection_networks)
         self.finalizers = torch.nn.ModuleList(finalizers)
 
-    def forward(self, x, centerbias, x_hist=None, y_hist=None, durations=None):
-        orig_shape = x.shape
-        x = F.interpolate(
-            x,
-            scale_factor=1 / self.downsample,
-            recompute_scale_factor=False,
-        )
+        self.fused_readout = None
+        self._fused_tensors = []
+        self._fused_version = None
+        # loading can also replace the parameters (`assign=True`), which the version doesn't see
+        self.register_load_state_dict_post_hook(DeepGazeIIIMixture._invalidate_fused_readout)
+
+    @staticmethod
+    def _invalidate_fused_readout(module, incompatible_keys):
+        module._fused_version = None
+
+    def _component_version(self):
+        # changes whenever a fused weight is updated in place (optimizer steps, load_state_dict) or its data is replaced
+        return tuple((tensor.data_ptr(), tensor._version) for tensor in self._fused_tensors)
+
+    def fuse_components(self, fuse=True):
+        """Evaluates all components together in eval mode (see `fused.FusedMixtureReadout`).
+
+        The fused readout is a copy of the component weights. It is rebuilt when
+        they change (training, `load_state_dict`, moving the model), so it never
+        runs with stale weights. `fuse_components(False)` switches back to
+        evaluating the components one by one.
+        """
+        if fuse:
+            device = self.finalizers[0].center_bias_weight.device
+            self.fused_readout = FusedMixtureReadout(
+                self.saliency_networks, self.scanpath_networks, self.fixation_selection_networks, self.finalizers,
+            ).to(device)
+            components = [self.saliency_networks, self.scanpath_networks, self.fixation_selection_networks, self.finalizers]
+            self._fused_tensors = [
+                tensor for component in components for tensor in itertools.chain(component.parameters(), component.buffers())
+            ]
+            self._fused_version = self._component_version()
+        else:
+            self.fused_readout = None
+            self._fused_tensors = []
+            self._fused_version = None
+        return self
+
+    def extract_features(self, x, centerbias):
+        """Backbone features at readout resolution, the input of `forward_features`."""
+        x, orig_shape = downsample_input(x, centerbias, self.downsample, recompute_scale_factor=False)
         x = self.features(x)
 
-        readout_shape = [math.ceil(orig_shape[2] / self.downsample / self.readout_factor), math.ceil(orig_shape[3] / self.downsample / self.readout_factor)]
+        readout_shape = readout_size(orig_shape[2:], self.downsample, self.readout_factor)
         x = [F.interpolate(item, readout_shape) for item in x]
 
-        x = torch.cat(x, dim=1)
+        return torch.cat(x, dim=1)
+
+    def forward(self, x, centerbias, x_hist=None, y_hist=None, durations=None):
+        return self.forward_features(self.extract_features(x, centerbias), centerbias, x_hist=x_hist, y_hist=y_hist, durations=durations)
+
+    def forward_features(self, x, centerbias, x_hist=None, y_hist=None, durations=None):
+        readout_shape = list(x.shape[2:])
 
         predictions = []
 
         readout_input = x
 
+        # the scanpath features are the same for all components
+        scanpath_features = None
+        if any(scanpath_network is not None for scanpath_network in self.scanpath_networks):
+            scanpath_features = encode_scanpath_features(x_hist, y_hist, size=(centerbias.shape[1], centerbias.shape[2]), device=x.device, output_size=readout_shape)
+
+        if getattr(self, 'fused_readout', None) is not None and not self.training:
+            if self._fused_version != self._component_version():
+                self.fuse_components()
+            return self.fused_readout(readout_input, centerbias, scanpath_features)
+
         for saliency_network, scanpath_network, fixation_selection_network, finalizer in zip(
             self.saliency_networks, self.scanpath_networks, self.fixation_selection_networks, self.finalizers
         ):
@@ -310,8 +398,6 @@ class DeepGazeIIIMixture(torch.nn.Module):
             x = saliency_network(readout_input)
 
             if scanpath_network is not None:
-                scanpath_features = encode_scanpath_features(x_hist, y_hist, size=(orig_shape[2], orig_shape[3]), device=x.device)
-                scanpath_features = F.interpolate(scanpath_features, readout_shape)
                 y = scanpath_network(scanpath_features)
             else:
                 y = None
@@ -334,6 +420,12 @@ class MixtureModel(torch.nn.Module):
         super().__init__()
         self.models = torch.nn.ModuleList(models)
 
+    def fuse_components(self, fuse=True):
+        """Fuses the components of all mixtures (see `DeepGazeIIIMixture.fuse_components`)."""
+        for model in self.models:
+            model.fuse_components(fuse)
+        return self
+
     def forward(self, *args, **kwargs):
         predictions = [model.forward(*args, **kwargs) for model in self.models]
         predictions = torch.cat(predictions, dim=1)
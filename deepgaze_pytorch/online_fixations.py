@@ -0,0 +1,255 @@
+"""Online fixation detection for live gaze sample feeds.
+
+`OnlineFixationDetector` consumes gaze samples one at a time (or in small
+chunks) and emits each fixation as soon as it is closed. Fed with the samples
+of a complete recording followed by `finish()`, it emits exactly the
+fixations that `deepgaze_pytorch.fixations.get_fixation` returns for the same
+samples and parameters.
+
+Every detector only keeps running extremes and the previous sample. Samples
+are buffered only while their label is still undecided or while they belong
+to the currently open fixation, so memory is bounded by the longest open
+segment and not by the length of the recording.
+"""
+from collections import deque, namedtuple
+
+import numpy as np
+
+from .fixations import combine_labels, _check_algorithm_mode
+
+
+FixationEvent = namedtuple('FixationEvent', ['start', 'end', 'x', 'y', 'start_time', 'end_time'])
+FixationEvent.__doc__ = """A detected fixation.
+
+`start` and `end` are the (exclusive) sample indices since the beginning of the
+stream, `x` and `y` the centroid of the fixation samples and `start_time` and
+`end_time` the timestamps of the first and last sample of the fixation (None if
+no timestamps were given).
+"""
+
+
+class _OnlineIVT(object):
+    """Incremental version of `fixations.ivt_segments`."""
+
+    def __init__(self, time_interval, velocity_threshold, min_fixation_duration):
+        self.time_interval = time_interval
+        self.velocity_threshold = velocity_threshold
+        self.min_fixation_duration = min_fixation_duration
+
+        self.previous = None
+        self.run_start = None  # velocity index of the open slow run
+        self.known = 0  # labels of samples before this index are final
+        self.segments = deque()
+
+    def push(self, index, x, y):
+        if self.previous is not None:
+            velocity = np.sqrt((x - self.previous[0])**2 + (y - self.previous[1])**2) / self.time_interval
+            velocity_index = index - 1
+            if velocity < self.velocity_threshold:
+                if self.run_start is None:
+                    self.run_start = velocity_index
+            else:
+                if self.run_start is not None:
+                    if (velocity_index - self.run_start) * self.time_interval >= self.min_fixation_duration:
+                        self.segments.append((self.run_start + 1, velocity_index + 1))
+                    self.run_start = None
+        self.previous = (x, y)
+
+        self.known = index + 1 if self.run_start is None else self.run_start + 1
+
+    def finish(self, length):
+        # runs which are not closed by a fast sample are discarded
+        self.run_start = None
+        self.known = length
+
+
+class _OnlineIDT(object):
+    """Incremental version of `fixations.idt_segments`."""
+
+    def __init__(self, time_interval, dispersion_threshold, min_fixation_duration):
+        self.time_interval = time_interval
+        self.dispersion_threshold = dispersion_threshold
+        self.min_fixation_duration = min_fixation_duration
+
+        self.window_start = 0
+        self.extremes = None  # (x_max, x_min, y_max, y_min) of the open window
+        self.segments = deque()
+
+    @property
+    def known(self):
+        return self.window_start
+
+    def _close(self, end):
+        if end > self.window_start and (end - self.window_start) * self.time_interval >= self.min_fixation_duration:
+            self.segments.append((self.window_start, end))
+
+    def _inside(self, extremes):
+        x_max, x_min, y_max, y_min = extremes
+        return x_max - x_min < self.dispersion_threshold and y_max - y_min < self.dispersion_threshold
+
+    def push(self, index, x, y):
+        if self.extremes is not None:
+            x_max, x_min, y_max, y_min = self.extremes
+            extremes = (np.maximum(x_max, x), np.minimum(x_min, x), np.maximum(y_max, y), np.minimum(y_min, y))
+            if self._inside(extremes):
+                self.extremes = extremes
+                return
+            self._close(index)
+
+        # start a new window with this sample
+        self.window_start = index
+        self.extremes = (x, x, y, y)
+        if not self._inside(self.extremes):
+            # not even a single sample fits (see `fixations.idt_segments`)
+            self.window_start = index + 1
+            self.extremes = None
+
+    def finish(self, length):
+        self._close(length)
+        self.window_start = length
+        self.extremes = None
+
+
+def _segment_labels(segments, start, stop):
+    """Labels of the samples in [start, stop) covered by `segments`; drops segments ending before `stop`."""
+    labels = np.zeros(stop - start, dtype=bool)
+    for segment_start, segment_end in segments:
+        if segment_start >= stop:
+            break
+        labels[max(segment_start, start) - start:segment_end - start] = True
+    while segments and segments[0][1] <= stop:
+        segments.popleft()
+    return labels
+
+
+class OnlineFixationDetector(object):
+    """Incremental fixation detection with the same semantics as `fixations.get_fixation`.
+
+    Args:
+        time_interval (float): time between two samples in seconds
+        algorithm_mode (int, optional): 0 (AND), 1 (OR), 2 (I-VT only) or 3 (I-DT only)
+        velocity_threshold (float, optional): I-VT velocity threshold in pixels/second
+        dispersion_threshold (float, optional): I-DT spatial dispersion threshold in pixels
+        min_fixation_duration (float, optional): minimum fixation duration in seconds
+        dtype (numpy dtype, optional): dtype in which samples are processed. Use the dtype
+            of the batch data to get bit-identical centroids (default: float64).
+    """
+
+    def __init__(self, time_interval, algorithm_mode=0, velocity_threshold=1000, dispersion_threshold=25, min_fixation_duration=0.1, dtype=np.float64):
+        _check_algorithm_mode(algorithm_mode)
+
+        self.time_interval = time_interval
+        self.algorithm_mode = algorithm_mode
+        self.dtype = np.dtype(dtype)
+
+        self._ivt = _OnlineIVT(time_interval, velocity_threshold, min_fixation_duration) if algorithm_mode != 3 else None
+        self._idt = _OnlineIDT(time_interval, dispersion_threshold, min_fixation_duration) if algorithm_mode != 2 else None
+
+        self.sample_count = 0
+        self.finished = False
+
+        self._processed = 0  # combined labels are final before this index
+        self._fixation_start = None
+        # samples starting at index `_buffer_offset` which might still be part of a fixation
+        self._buffer_offset = 0
+        self._buffer = []
+
+    def _known(self):
+        return min(detector.known for detector in (self._ivt, self._idt) if detector is not None)
+
+    def _emit(self, start, end):
+        samples = self._buffer[start - self._buffer_offset:end - self._buffer_offset]
+        xs = np.array([sample[0] for sample in samples], dtype=self.dtype)
+        ys = np.array([sample[1] for sample in samples], dtype=self.dtype)
+        return FixationEvent(start, end, np.mean(xs), np.mean(ys), samples[0][2], samples[-1][2])
+
+    def _advance(self):
+        known = self._known()
+        if known <= self._processed:
+            return []
+
+        ivt_labels = _segment_labels(self._ivt.segments, self._processed, known) if self._ivt is not None else None
+        idt_labels = _segment_labels(self._idt.segments, self._processed, known) if self._idt is not None else None
+        labels = combine_labels(ivt_labels, idt_labels, self.algorithm_mode)
+
+        events = []
+        previous_label = self._fixation_start is not None
+        for offset in np.flatnonzero(labels != np.concatenate(([previous_label], labels[:-1]))):
+            index = self._processed + int(offset)
+            if labels[offset]:
+                self._fixation_start = index
+            else:
+                events.append(self._emit(self._fixation_start, index))
+                self._fixation_start = None
+
+        self._processed = known
+
+        keep_from = self._processed if self._fixation_start is None else self._fixation_start
+        del self._buffer[:keep_from - self._buffer_offset]
+        self._buffer_offset = keep_from
+
+        return events
+
+    def push(self, x, y, t=None):
+        """Adds one sample and returns the list of fixations closed by it."""
+        if self.finished:
+            raise ValueError("Detector already finished")
+
+        x = self.dtype.type(x)
+        y = self.dtype.type(y)
+        index = self.sample_count
+        self.sample_count += 1
+        self._buffer.append((x, y, t))
+
+        for detector in (self._ivt, self._idt):
+            if detector is not None:
+                detector.push(index, x, y)
+
+        return self._advance()
+
+    def extend(self, xs, ys, ts=None):
+        """Adds a chunk of samples and returns the list of fixations closed by them."""
+        if ts is None:
+            ts = [None] * len(xs)
+        events = []
+        for x, y, t in zip(xs, ys, ts):
+            events.extend(self.push(x, y, t))
+        return events
+
+    def finish(self):
+        """Ends the stream and returns the remaining fixations."""
+        if self.finished:
+            return []
+
+        for detector in (self._ivt, self._idt):
+            if detector is not None:
+                detector.finish(self.sample_count)
+
+        events = self._advance()
+        if self._fixation_start is not None:
+            events.append(self._emit(self._fixation_start, self.sample_count))
+            self._fixation_start = None
+        self.finished = True
+
+        return events
+
+
+def iter_fixations(samples, time_interval, **kwargs):
+    """Yields fixations from an iterable of (t, x, y) samples as soon as they are closed.
+
+    Keyword arguments are passed to `OnlineFixationDetector`.
+    """
+    detector = OnlineFixationDetector(time_interval, **kwargs)
+    for t, x, y in samples:
+        yield from detector.push(x, y, t)
+    yield from detector.finish()
+
+
+async def aiter_fixations(samples, time_interval, **kwargs):
+    """Asynchronous version of `iter_fixations` for async iterables of (t, x, y) samples."""
+    detector = OnlineFixationDetector(time_interval, **kwargs)
+    async for t, x, y in samples:
+        for event in detector.push(x, y, t):
+            yield event
+    for event in detector.finish():
+        yield event
@@ -26,7 +26,7 @@ import yaml
 
 from .data import ImageDataset, FixationDataset, ImageDatasetSampler, FixationMaskTransform
 #from .loading import import_class, build_model, DeepGazeCheckpointModel, SharedPyTorchModel, _get_from_config
-from .metrics import log_likelihood, nss, auc
+from .metrics import log_likelihood, saliency_metrics, MetricAccumulator, MetricAccumulators, ShuffledNegatives
 from .modules import DeepGazeII
 
 
@@ -34,52 +34,89 @@ from .modules import DeepGazeII
 baseline_performance = cached(LRU(max_size=3))(lambda model, *args, **kwargs: model.information_gain(*args, **kwargs))
 
 
+def _forward_batch(model, batch, device):
+    """Runs the model on a batch; returns `(log_density, fixation_mask, weights, stimulus_ids)`.
+
+    Batches with cached backbone `features` (see `data.FeatureCache`) skip the
+    backbone and go through the model's `forward_features`.
+    """
+    centerbias = batch.pop('centerbias').to(device)
+    fixation_mask = batch.pop('fixation_mask').to(device)
+    x_hist = batch.pop('x_hist', torch.tensor([])).to(device)
+    y_hist = batch.pop('y_hist', torch.tensor([])).to(device)
+    weights = batch.pop('weight').to(device)
+    durations = batch.pop('durations', torch.tensor([])).to(device)
+    stimulus_ids = batch.pop('n', None)
+    if stimulus_ids is not None:
+        stimulus_ids = stimulus_ids.to(device)
+
+    if 'features' in batch:
+        x = batch.pop('features').to(device).to(torch.get_default_dtype())
+        forward = model.forward_features
+    else:
+        x = batch.pop('image').to(device)
+        forward = model
+
+    kwargs = {}
+    for key, value in dict(batch).items():
+        kwargs[key] = value.to(device)
+
+    if isinstance(model, DeepGazeII):
+        log_density = forward(x, centerbias, **kwargs)
+    else:
+        log_density = forward(x, centerbias, x_hist=x_hist, y_hist=y_hist, durations=durations, **kwargs)
+
+    return log_density, fixation_mask, weights, stimulus_ids
+
+
+def evaluate_metrics(model, dataset, device, metrics, shuffled_negatives=None):
+    """Accumulates `metrics` (see `metrics.saliency_metrics`, and `pooledAUC`) over `dataset`.
+
+    `sAUC` uses `shuffled_negatives`, by default the fixations of the whole dataset
+    behind the `dataset` loader, so it matches pysaliency.
+
+    Returns the `MetricAccumulators`, which can be merged with the results
+    of other shards of the same dataset.
+    """
+    batch_metrics = [metric for metric in metrics if metric != 'pooledAUC']
+    accumulators = MetricAccumulators(batch_metrics, pooled_auc='pooledAUC' in metrics)
+
+    if 'sAUC' in metrics and shuffled_negatives is None:
+        data_source = getattr(dataset, 'dataset', dataset)
+        shuffled_negatives = ShuffledNegatives.from_fixations(data_source.stimuli, data_source.fixations)
+
+    display_metric = next((metric for metric in ['LL', 'NSS', 'AUC'] if metric in metrics), None)
+
+    with torch.no_grad():
+        pbar = tqdm(dataset)
+        for batch in pbar:
+            log_density, fixation_mask, weights, stimulus_ids = _forward_batch(model, batch, device)
+
+            batch_scores = saliency_metrics(log_density, fixation_mask, weights, metrics=batch_metrics,
+                                            stimulus_ids=stimulus_ids, shuffled_negatives=shuffled_negatives)
+            accumulators.update(
+                {metric_name: score.item() for metric_name, score in batch_scores.items()},
+                weights, log_density=log_density, fixation_mask=fixation_mask,
+            )
+
+            if display_metric is not None:
+                pbar.set_description('{} {:.05f}'.format(display_metric, accumulators[display_metric].value))
+
+    return accumulators
+
+
 def eval_epoch(model, dataset, baseline_information_gain, device, metrics=None):
     model.eval()
 
     if metrics is None:
         metrics = ['LL', 'IG', 'NSS', 'AUC']
 
-    metric_scores = {}
-    metric_functions = {
-        'LL': log_likelihood,
-        'NSS': nss,
-        'AUC': auc,
-    }
-    batch_weights = []
+    # IG is computed from the LL relative to the baseline of the whole dataset
+    batch_metrics = [metric for metric in metrics if metric != 'IG']
+    if 'IG' in metrics and 'LL' not in batch_metrics:
+        batch_metrics.append('LL')
 
-    with torch.no_grad():
-        pbar = tqdm(dataset)
-        for batch in pbar:
-            image = batch.pop('image').to(device)
-            centerbias = batch.pop('centerbias').to(device)
-            fixation_mask = batch.pop('fixation_mask').to(device)
-            x_hist = batch.pop('x_hist', torch.tensor([])).to(device)
-            y_hist = batch.pop('y_hist', torch.tensor([])).to(device)
-            weights = batch.pop('weight').to(device)
-            durations = batch.pop('durations', torch.tensor([])).to(device)
-
-            kwargs = {}
-            for key, value in dict(batch).items():
-                kwargs[key] = value.to(device)
-
-            if isinstance(model, DeepGazeII):
-                log_density = model(image, centerbias, **kwargs)
-            else:
-                log_density = model(image, centerbias, x_hist=x_hist, y_hist=y_hist, durations=durations, **kwargs)
-
-            for metric_name, metric_fn in metric_functions.items():
-                if metric_name not in metrics:
-                    continue
-                metric_scores.setdefault(metric_name, []).append(metric_fn(log_density, fixation_mask, weights=weights).detach().cpu().numpy())
-            batch_weights.append(weights.detach().cpu().numpy().sum())
-
-            for display_metric in ['LL', 'NSS', 'AUC']:
-                if display_metric in metrics:
-                    pbar.set_description('{} {:.05f}'.format(display_metric, np.average(metric_scores[display_metric], weights=batch_weights)))
-                    break
-
-    data = {metric_name: np.average(scores, weights=batch_weights) for metric_name, scores in metric_scores.items()}
+    data = evaluate_metrics(model, dataset, device, batch_metrics).values()
     if 'IG' in metrics:
         data['IG'] = data['LL'] - baseline_information_gain
 
@@ -87,42 +124,24 @@ def eval_epoch(model, dataset, baseline_information_gain, device, metrics=None):
 
 def train_epoch(model, dataset, optimizer, device):
     model.train()
-    losses = []
-    batch_weights = []
+    loss_accumulator = MetricAccumulator()
 
     pbar = tqdm(dataset)
     for batch in pbar:
         optimizer.zero_grad()
 
-        image = batch.pop('image').to(device)
-        centerbias = batch.pop('centerbias').to(device)
-        fixation_mask = batch.pop('fixation_mask').to(device)
-        x_hist = batch.pop('x_hist', torch.tensor([])).to(device)
-        y_hist = batch.pop('y_hist', torch.tensor([])).to(device)
-        weights = batch.pop('weight').to(device)
-        durations = batch.pop('durations', torch.tensor([])).to(device)
-
-        kwargs = {}
-        for key, value in dict(batch).items():
-            kwargs[key] = value.to(device)
-
-        if isinstance(model, DeepGazeII):
-            log_density = model(image, centerbias, **kwargs)
-        else:
-            log_density = model(image, centerbias, x_hist=x_hist, y_hist=y_hist, durations=durations, **kwargs)
+        log_density, fixation_mask, weights, _ = _forward_batch(model, batch, device)
 
         loss = -log_likelihood(log_density, fixation_mask, weights=weights)
-        losses.append(loss.detach().cpu().numpy())
-
-        batch_weights.append(weights.detach().cpu().numpy().sum())
+        loss_accumulator.update(loss.item(), weights.sum().item())
 
-        pbar.set_description('{:.05f}'.format(np.average(losses, weights=batch_weights)))
+        pbar.set_description('{:.05f}'.format(loss_accumulator.value))
 
         loss.backward()
 
         optimizer.step()
 
-    return np.average(losses, weights=batch_weights)
+    return loss_accumulator.value
 
 
 def restore_from_checkpoint(model, optimizer, scheduler, path):